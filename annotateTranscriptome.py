@@ -1,40 +1,76 @@
 import csv
+import sys
 import json
-import re
 import os
+import shutil
+import signal
+import tempfile
 import requests
 import time
 import subprocess
+import threading
+import queue
+import contextlib
 import multiprocessing as mp
 from tqdm import tqdm
-from collections import Counter
+from collections import Counter, OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+from multiprocessing.util import Finalize
 
 import click
 from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
-from orffinder import orffinder
+
+import orfEngine
+import pyhmmerEngine
+from hmmerDatabase import pressModel, DEFAULT_CACHE
+from hmmerTable import parseDomtblout
+from resultCache import ResultCache, MISSING, proteinHash, onNetworkFilesystem
+from fastaIndex import FastaIndex, readRange, balancedBlocks
+from annotationMetrics import RunMetrics, profiled
 
 # python annotateTranscriptome -i /lab/solexa_reddien/Patrick/10X_Pharynx_scRNAseq/dd_Smed_v6_trimmed_custom.fasta -o dd_smed_v6.tsv
 
-HMMSEARCHPATT = re.compile(
-    "b'\s+(?P<full_e>[\de\-\.]+)\s+(?P<full_score>[\de\-\.]+)\s+(?P<full_bias>[\de\-\.]+)\s+(?P<best_domain_e>[\de\-\.]+)\s+(?P<best_domain_score>[\de\-\.]+)\s+(?P<best_domain_bias>[\de\-\.]+)\s+(?P<exp>[\de\-\.]+)\s+(?P<N>[\de\-\.]+)\s+(?P<model>[A-Za-z0-9-_]+)\s+(?P<description>[A-Za-z0-9\s_\-\(\)]+)"
-)
-HMMSEARCHPATTKEY = [
-    "full_e",
-    "full_score",
-    "full_bias",
-    "best_domain_e",
-    "best_domain_score",
-    "best_domain_bias",
-    "exp",
-    "N",
-    "model",
-    "description",
+STDOUT = "/dev/stdout"  # hmmer writes its tables to files, point them at the pipe we read from
+INCLUSION_E = 0.01  # hmmer's default --incE, hits above it fall below the "inclusion threshold" line
+# findDomains gave up on a sequence, reported as no features but never cached
+TIMED_OUT = object()
+WORKER_CACHE = None  # each pool worker opens its own connection to the result cache
+# stage timers and counters of this process, workers hand theirs over after every task
+METRICS = RunMetrics()
+PROFILE_WORKER = False  # set in the few pool workers sampled for --profile
+# hmmer, model and cache settings, handed to every pool worker by initWorker
+WORKER_CONFIG = {}
+# fixed cost of one contig (an hmmscan start) counted in bases when splitting work into tasks
+CONTIG_OVERHEAD = 300
+HEADER = [
+    "contig ID",
+    "features",
+    "descriptions",
+    "no orf found",
+    "no domains, repeats, motifs, or features found",
+    "contig sequence",
+    "translated sequence (orffinder)",
 ]
-TMPDIR = "tmp"
 
 
-@click.command()
+class AnnotateGroup(click.Group):
+    # annotate is the default command, so command lines without a subcommand keep working
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] != "--help":
+            args = ["annotate"] + args
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=AnnotateGroup)
+def cli():
+    pass
+
+
+@cli.command(
+    "annotate",
+    help="Annotate the first ORF of every contig with its protein domains (the default command).",
+)
 @click.option(
     "-i",
     "--infile",
@@ -77,107 +113,847 @@ TMPDIR = "tmp"
     default=False,
     help="Also output a protein fasta file with all translated ORFs.",
 )
-def annotateSequences(infile, outfile, hmmerbin, model, cores, save_protein):
-    sequences = SeqIO.parse(infile, "fasta")
-    numSeqs = 0
+@click.option(
+    "--batch",
+    type=bool,
+    default=False,
+    help="Translate all ORFs first and scan them in chunks with one hmmscan process per chunk (keeps one entry per distinct ORF in memory for the whole run, so memory grows with the transcriptome).",
+)
+@click.option(
+    "--chunks",
+    type=int,
+    default=None,
+    help="Number of chunk files to split the ORFs into in batch mode (defaults to the number of cores).",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["hmmscan", "hmmsearch", "pyhmmer"]),
+    default="hmmscan",
+    help="Scan each ORF against the profiles (hmmscan), search all profiles against the ORFs (hmmsearch) or scan in this process with profiles loaded once (pyhmmer, needs the pyhmmer package). hmmsearch and pyhmmer always run in batch mode.",
+)
+@click.option(
+    "--press_cache",
+    type=str,
+    default=None,
+    help="Directory to build and cache the pressed HMM database in (defaults to next to the model).",
+)
+@click.option(
+    "--ordered",
+    type=bool,
+    default=False,
+    help="Write the output rows in the same order as the input fasta file.",
+)
+@click.option(
+    "--buffer",
+    type=int,
+    default=1000,
+    help="Maximum number of contigs being annotated or waiting to be written at once.",
+)
+@click.option(
+    "--dedup_size",
+    type=int,
+    default=200000,
+    help="Number of distinct ORFs whose hits are kept in memory for later contigs sharing them, the least recently seen are dropped and searched again (or read from --result_cache) if they come up later.",
+)
+@click.option(
+    "--resume",
+    type=bool,
+    default=False,
+    help="Reuse cached domain hits for ORFs already annotated against the same model, only new or changed sequences are scanned (new results are added to --result_cache).",
+)
+@click.option(
+    "--result_cache",
+    type=str,
+    default=None,
+    help="SQLite file caching the domain hits of every ORF, on a local disk (a cache on NFS or another network filesystem is refused, SQLite cannot share it there). Defaults to results.sqlite in ~/.cache/annotateTranscriptome with --resume, without either option no cache is kept.",
+)
+@click.option(
+    "--cache_size",
+    type=int,
+    default=2048,
+    help="Maximum size of the result cache in MB, the least recently used results are evicted.",
+)
+@click.option(
+    "--orf_min_length",
+    type=int,
+    default=75,
+    help="Minimum length in nucleotides of the ORF translated for each contig.",
+)
+@click.option(
+    "--timeout",
+    type=int,
+    default=120,
+    help="Seconds hmmscan may spend on one ORF before it is killed and the contig is reported without features.",
+)
+@click.option(
+    "--tmpdir",
+    type=str,
+    default=None,
+    help="Where to create the run's private scratch directory for batch mode (defaults to the system temp dir, a local disk or tmpfs is best).",
+)
+@click.option(
+    "--metrics",
+    type=str,
+    default=None,
+    help="Write per-stage timings, counters and the slowest contigs to this file (JSON, or CSV if it ends in .csv).",
+)
+@click.option(
+    "--profile",
+    type=str,
+    default=None,
+    help="Write cProfile stats of a sample of pool workers (of the main process in batch mode) to this file, view them with pstats or snakeviz.",
+)
+@click.option(
+    "--profile_workers",
+    type=int,
+    default=2,
+    help="Number of pool workers profiled with --profile.",
+)
+@click.option(
+    "--shard",
+    type=str,
+    default=None,
+    callback=lambda c, p, v: parseShard(v),
+    help="Only annotate slice i of N of the input ('i/N', i from 1), for job arrays. Writes <outfile>.shard<i>of<N>.tsv, combine the shards with the merge command.",
+)
+@click.option(
+    "--start_method",
+    type=click.Choice(["fork", "spawn", "forkserver"]),
+    default=None,
+    help="How pool workers are started (defaults to the platform's default).",
+)
+def annotateSequences(
+    infile,
+    outfile,
+    hmmerbin,
+    model,
+    cores,
+    save_protein,
+    batch,
+    chunks,
+    engine,
+    press_cache,
+    ordered,
+    buffer,
+    dedup_size,
+    resume,
+    result_cache,
+    cache_size,
+    orf_min_length,
+    timeout,
+    tmpdir,
+    metrics,
+    profile,
+    profile_workers,
+    shard,
+    start_method,
+):
+    start = time.perf_counter()
+    # index the fasta once (reusing its .fai), workers read their own byte ranges of it
+    index = FastaIndex(infile)
+    if shard is not None:
+        index = index.shard(shard[0] - 1, shard[1])
+        outfile = shardPath(outfile, shard)
+        metrics = shardPath(metrics, shard)
+        profile = shardPath(profile, shard)
+    numSeqs = len(index)
+    if engine == "pyhmmer" and pyhmmerEngine.pyhmmer is None:
+        raise click.UsageError("--engine pyhmmer needs the pyhmmer package")
+    # find or build the pressed database once, every pool worker gets its path when it starts
+    press = pyhmmerEngine.press if engine == "pyhmmer" else None
+    model, modelInfo = pressModel(model, hmmerbin, press_cache, press)
+    if resume and result_cache is None:
+        os.makedirs(DEFAULT_CACHE, exist_ok=True)
+        result_cache = os.path.join(DEFAULT_CACHE, "results.sqlite")
+    if result_cache is not None and onNetworkFilesystem(
+        os.path.dirname(os.path.abspath(result_cache))
+    ):
+        # every shard of a job array and every pool worker would share one WAL file across hosts
+        raise click.UsageError(
+            f"the result cache {result_cache} is on a network filesystem, where SQLite cannot share it "
+            "between processes, pass --result_cache with a path on a local disk"
+        )
+    cacheArgs = None if result_cache is None else (result_cache, modelInfo["sha256"])
+    config = {
+        "model": model,
+        "hmmerbin": hmmerbin,
+        "timeout": timeout,
+        "orfMinLength": orf_min_length,
+        "resume": resume,
+        "resultCache": cacheArgs,
+    }
+    if engine in ["hmmsearch", "pyhmmer"]:
+        batch = True
+    ctx = mp.get_context(start_method)
+    # the first few workers to start claim the profiling slots
+    profileSlots = ctx.Value("i", profile_workers if profile and not batch else 0)
+    poolArgs = {"initializer": initWorker, "initargs": (config, profileSlots)}
+    # rows and proteins are streamed to disk as soon as they are ready
+    proteinFile = None
     if save_protein:
-        proteins = []
-    if not os.path.exists(TMPDIR):
-        os.mkdir(TMPDIR)
-    with open(infile, "r") as f:
-        numSeqs = f.read().count(">")
-    with open(outfile, "w") as f:
-        header = [
-            "contig ID",
-            "features",
-            "descriptions",
-            "no orf found",
-            "no domains, repeats, motifs, or features found",
-            "contig sequence",
-            "translated sequence (orffinder)",
-        ]
+        proteinFile = open(proteinPath(outfile), "w", buffering=1)
+    with open(outfile, "w", buffering=1) as f:
         writer = csv.writer(f, delimiter="\t")
-        writer.writerow(header)
-        pool = mp.Pool(cores)
-        results = []
-        for result in tqdm(
-            pool.imap_unordered(processSequence, sequences), total=numSeqs
-        ):
-            results.append(result)
-        for r in results:
-            writer.writerow(r)
+        writer.writerow(HEADER)
+        if batch:
+            pool = None
+            rows = annotateBatch(
+                index,
+                tmpdir,
+                hmmerbin,
+                model,
+                cores,
+                chunks,
+                engine,
+                modelInfo["descriptions"],
+                ordered,
+                None if cacheArgs is None else ResultCache(*cacheArgs),
+                resume,
+                lambda: ctx.Pool(cores, **poolArgs),
+            )
+        else:
+            pool = ctx.Pool(cores, **poolArgs)
+            tasks, window = scheduleTasks(index, cores, buffer, ordered)
+            rows = dedupRows(pool, tasks, ordered, window, buffer, dedup_size)
+        with profiled(METRICS, batch and profile is not None):
+            for r in tqdm(rows, total=numSeqs):
+                writer.writerow(r)
+                if proteinFile is not None:
+                    contig = r[0]
+                    sequence = r[6]
+                    if sequence is not None:
+                        protein = SeqRecord(
+                            sequence, id=contig, name="", description=""
+                        )
+                        SeqIO.write(protein, proteinFile, "fasta-2line")
+        if pool is not None:
+            # let the workers close their cache connections before evicting
+            pool.close()
+            pool.join()
+    if proteinFile is not None:
+        proteinFile.close()
+    if cacheArgs is not None:
+        cache = ResultCache(*cacheArgs)
+        with METRICS.timer("cache eviction"):
+            cache.evict(cache_size * 2**20)
+        cache.close()
+    distinct = METRICS.counters["distinct orfs"]
+    if distinct:
+        print(
+            f"{METRICS.counters['orfs']} contigs with an ORF share {distinct} distinct ORFs "
+            f"(collapse ratio {METRICS.counters['orfs'] / distinct:.2f})"
+        )
+    if metrics is not None:
+        METRICS.write(metrics, time.perf_counter() - start)
+    if profile is not None and not METRICS.writeProfile(profile):
+        print("no profile was collected")
+
+
+@cli.command(help="Combine the tables of a sharded run into one, in input order.")
+@click.option(
+    "-i",
+    "--infile",
+    required=True,
+    type=str,
+    help="The fasta file the shards were annotated from.",
+)
+@click.option(
+    "-o",
+    "--outfile",
+    required=True,
+    type=str,
+    help="The outfile given to the shards, the merged tsv is written here.",
+)
+@click.option(
+    "--shards", required=True, type=int, help="Number of shards (N of --shard i/N)."
+)
+@click.option(
+    "-p",
+    "--save_protein",
+    type=bool,
+    default=False,
+    help="Also merge the shards' protein fasta files.",
+)
+def merge(infile, outfile, shards, save_protein):
+    # concatenate the shards in input order, shards written without --ordered are reordered one at a time
+    csv.field_size_limit(sys.maxsize)
+    index = FastaIndex(infile)
+    parts = [index.shard(i, shards) for i in range(shards)]
+    paths = [shardPath(outfile, (i + 1, shards)) for i in range(shards)]
+    if save_protein:
+        paths += [proteinPath(p) for p in paths[:shards]]
+    missing = [p for p in paths if not os.path.exists(p)]
+    if missing:
+        raise click.ClickException(f"missing shard files: {', '.join(missing)}")
+    # write next to the outfile and only put it in place once every shard checked out
+    tmpPaths = [f"{outfile}.tmp"]
+    if save_protein:
+        tmpPaths.append(f"{proteinPath(outfile)}.tmp")
+    try:
+        with contextlib.ExitStack() as files:
+            f = files.enter_context(open(tmpPaths[0], "w", newline=""))
+            writer = csv.writer(f, delimiter="\t")
+            writer.writerow(HEADER)
             if save_protein:
-                contig = r[0]
-                sequence = r[6]
-                if sequence is not None:
-                    protein = SeqRecord(sequence, id=contig, name="", description="")
-                    proteins.append(protein)
-        pool.close()
+                proteinFile = files.enter_context(open(tmpPaths[1], "w"))
+            for part, path in zip(parts, paths):
+                rows = readShard(path, part)
+                for contig in part:
+                    writer.writerow(rows[contig])
+                if save_protein:
+                    proteins = SeqIO.to_dict(SeqIO.parse(proteinPath(path), "fasta"))
+                    for contig in part:
+                        if contig in proteins:
+                            SeqIO.write(proteins[contig], proteinFile, "fasta-2line")
+    except BaseException:
+        for tmpPath in tmpPaths:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+        raise
+    os.replace(tmpPaths[0], outfile)
     if save_protein:
-        baseName = outfile.split(".")[0]
-        SeqIO.write(proteins, f"{baseName}_protein.fasta", "fasta-2line")
-    os.rmdir(TMPDIR)
+        os.replace(tmpPaths[1], proteinPath(outfile))
+    print(f"merged {shards} shards with {len(index)} contigs into {outfile}")
+
+
+def readShard(path, part):
+    # the rows of one shard by contig, every contig of the shard exactly once
+    rows = {}
+    with open(path, "r", newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        if next(reader, None) != HEADER:
+            raise click.ClickException(f"{path} is not an annotateTranscriptome table")
+        for row in reader:
+            if row[0] in rows or row[0] not in part.positions:
+                raise click.ClickException(
+                    f"{path}: contig {row[0]} is duplicated or belongs to another shard"
+                )
+            rows[row[0]] = row
+    missing = [contig for contig in part if contig not in rows]
+    if missing:
+        raise click.ClickException(
+            f"{path} is missing {len(missing)} contigs, the first is {missing[0]} "
+            "(did the shard finish?)"
+        )
+    return rows
+
+
+def parseShard(shard):
+    if shard is None:
+        return None
+    try:
+        i, n = (int(x) for x in shard.split("/"))
+    except ValueError:
+        raise click.BadParameter("expected 'i/N', ex. 3/10", param_hint="--shard")
+    if not 1 <= i <= n:
+        raise click.BadParameter(f"{i} is not between 1 and {n}", param_hint="--shard")
+    return i, n
+
+
+def shardPath(path, shard):
+    # out.tsv -> out.shard3of10.tsv
+    if path is None or shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard[0]}of{shard[1]}{ext}"
+
+
+def proteinPath(outfile):
+    # out.tsv -> out_protein.fasta, out.shard3of10.tsv -> out_protein.shard3of10.fasta
+    shard = os.path.splitext(os.path.splitext(outfile)[0])[1]
+    if not shard.startswith(".shard"):
+        shard = ""
+    return f"{outfile.split('.')[0]}_protein{shard}.fasta"
+
+
+def scheduleTasks(index, cores, buffer, ordered):
+    # guided self-scheduling: every task takes a share of the work still left, so tasks shrink towards the
+    # end of the run and no core sits idle behind one big last task; unordered runs also start with the
+    # longest contigs so the slowest work is never left for last
+    order = list(range(len(index)))
+    lengths = index.lengths()
+    if not ordered:
+        order.sort(key=lambda i: -lengths[i])
+    costs = [lengths[i] + CONTIG_OVERHEAD for i in order]
+    remaining = sum(costs)
+    # a task never holds more contigs than its share of the buffer
+    maxRecords = max(1, buffer // (4 * cores))
+    tasks = []
+    task = []
+    taskCost = 0
+    target = remaining / (2 * cores)
+    for i, cost in zip(order, costs):
+        task.append(i)
+        taskCost += cost
+        if taskCost >= target or len(task) == maxRecords:
+            tasks.append(task)
+            remaining -= taskCost
+            task = []
+            taskCost = 0
+            target = remaining / (2 * cores)
+    if task:
+        tasks.append(task)
+    # ordered tasks hold consecutive records, read as one byte range
+    if ordered:
+        tasks = [[index.recordRange(t[0], t[-1] + 1)] for t in tasks]
+    else:
+        tasks = [[index.recordRange(i, i + 1) for i in t] for t in tasks]
+    tasks = [[(index.path, *r) for r in t] for t in tasks]
+    return tasks, max(2 * cores, buffer // maxRecords)
+
+
+def initWorker(config, profileSlots):
+    global PROFILE_WORKER
+    WORKER_CONFIG.update(config)
+    with profileSlots.get_lock():
+        if profileSlots.value > 0:
+            profileSlots.value -= 1
+            PROFILE_WORKER = True
+
+
+def dedupRows(pool, tasks, ordered, taskWindow, buffer, dedupSize):
+    # isoforms and near-duplicate contigs often share their first ORF: every distinct ORF is searched once
+    # and its hits are fanned back out to every contig that translates to it. At most `taskWindow` tasks
+    # are translated ahead, and new ones wait while `buffer` searches are running or `buffer` contigs are
+    # held back for a search (behind a slow one with --ordered), so memory stays flat
+    finished = queue.Queue()
+    # protein hash -> hits of the `dedupSize` most recently seen ORFs
+    results = OrderedDict()
+    # protein hash -> slots of the contigs waiting for that ORF's search
+    waiting = {}
+    # [contig, ORF, hits] of every contig not written yet, in input order, with --ordered
+    backlog = deque()
+    # task index -> contigs and ORFs translated ahead of their turn, with --ordered
+    translated = {}
+    tasks = enumerate(tasks)
+    buffer = max(1, buffer)
+    dedupSize = max(1, dedupSize)
+    submitted = 0
+    processed = 0
+    searches = 0
+    held = 0
+
+    def submit(func, arg, kind):
+        pool.apply_async(
+            func,
+            (arg,),
+            callback=lambda result: finished.put((kind, result)),
+            error_callback=finished.put,
+        )
+
+    def addContigs(pairs):
+        # queue a search for every ORF not seen recently and return the rows that are already complete
+        nonlocal searches, held
+        rows = []
+        for sequence, protein in pairs:
+            METRICS.count("contigs")
+            # the hits are filled in once known, the slot outlives the ORF's entry in `results`
+            slot = [sequence, protein, None]
+            if protein is None:
+                METRICS.count("no orf")
+            else:
+                METRICS.count("orfs")
+                digest = proteinHash(protein)
+                if digest in results:
+                    METRICS.count("duplicate orfs")
+                    results.move_to_end(digest)
+                    slot[2] = results[digest]
+                else:
+                    if digest in waiting:
+                        METRICS.count("duplicate orfs")
+                    else:
+                        METRICS.count("distinct orfs")
+                        waiting[digest] = []
+                        searches += 1
+                        task = (digest, sequence.id, len(sequence), protein)
+                        submit(searchProtein, task, "searched")
+                    slot[2] = MISSING
+                    waiting[digest].append(slot)
+            if ordered:
+                backlog.append(slot)
+                held += 1
+            elif slot[2] is MISSING:
+                held += 1
+            else:
+                rows.append(buildRow(*slot))
+        return rows
+
+    def ready():
+        nonlocal held
+        rows = []
+        while backlog and backlog[0][2] is not MISSING:
+            held -= 1
+            rows.append(buildRow(*backlog.popleft()))
+        return rows
+
+    while True:
+        while (
+            submitted - processed < taskWindow and searches < buffer and held < buffer
+        ):
+            task = next(tasks, None)
+            if task is None:
+                break
+            submit(translateTask, task, "translated")
+            submitted += 1
+        if processed == submitted and searches == 0:
+            break
+        outcome = finished.get()
+        if isinstance(outcome, BaseException):
+            raise outcome
+        kind, (key, value, metrics) = outcome
+        METRICS.merge(metrics)
+        if kind == "searched":
+            searches -= 1
+            results[key] = value
+            if len(results) > dedupSize:
+                results.popitem(last=False)
+            slots = waiting.pop(key)
+            for slot in slots:
+                slot[2] = value
+            if not ordered:
+                held -= len(slots)
+                yield from (buildRow(*slot) for slot in slots)
+        elif not ordered:
+            processed += 1
+            yield from addContigs(value)
+        else:
+            translated[key] = value
+            while processed in translated:
+                yield from addContigs(translated.pop(processed))
+                processed += 1
+        if ordered:
+            yield from ready()
 
 
 def findDomains(record):
-    c = click.get_current_context()
-    hmmfile = c.params["model"]
-    hmmerbin = c.params["hmmerbin"]
+    hmmfile = WORKER_CONFIG["model"]
+    hmmerbin = WORKER_CONFIG["hmmerbin"]
     scanPath = os.path.join(hmmerbin, "hmmscan")
-    # make a temporary ORF sequence file
-    orf = f"{record.id}.fasta"
-    orfPath = os.path.join(TMPDIR, orf)
-    with open(orfPath, "w") as f:
-        SeqIO.write(record, f, "fasta")
-    # run hmmscan with protein sequence against HMM file
+    # run hmmscan with the protein sequence on stdin against the HMM file and read the domain table from stdout
     hmmscan = subprocess.Popen(
-        f"{scanPath} --notextw {hmmfile} {orfPath}",
-        shell=True,
+        [scanPath, "--notextw", "-o", os.devnull, "--domtblout", STDOUT, hmmfile, "-"],
+        stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
+        text=True,
     )
+    timer = threading.Timer(WORKER_CONFIG["timeout"], hmmscan.kill)
+    timer.start()
     try:
-        hmmscan.wait(timeout=120)  # wait for hmmscan to complete
-        os.remove(orfPath)  # remove temporary ORF sequence file
-    except subprocess.TimeoutExpired:
-        hmmscan.kill()
-        os.remove(orfPath)  # remove temporary ORF sequence file
-        return None
-    # grab results from scan
-    results = hmmscan.stdout.readlines()
-    allResults = []
-    start = 16
-    if "No hits detected that satisfy reporting thresholds" in str(results[start]):
-        return None
-    else:
-        # determine the number of results returned (# of lines after line 15 that are not just a carriage return)
-        counter = start
-        m = HMMSEARCHPATT.search(str(results[counter]))
-        while m:
-            counter += 1
-            m = HMMSEARCHPATT.search(str(results[counter]))
-        for i in range(start, counter):
-            m = HMMSEARCHPATT.search(str(results[i]))
-            formattedMatches = {}
-            for key in HMMSEARCHPATTKEY:
-                formattedMatches[key] = m[key]
-            allResults.append(formattedMatches)
-        return allResults
-
-
-def processSequence(sequence):
-    orfs = orffinder.getORFNucleotides(sequence)
+        try:
+            SeqIO.write(record, hmmscan.stdin, "fasta")
+            hmmscan.stdin.close()
+        except BrokenPipeError:
+            pass  # killed or failed before reading its input, the return code tells which
+        # no rows means no hits satisfied the reporting thresholds
+        hits = collectHits(parseDomtblout(hmmscan.stdout), "hmmscan", None)
+        stderr = hmmscan.stderr.read()
+        hmmscan.wait()
+    finally:
+        timer.cancel()
+    if hmmscan.returncode == -signal.SIGKILL:
+        return TIMED_OUT
+    if hmmscan.returncode != 0:
+        raise subprocess.CalledProcessError(
+            hmmscan.returncode, hmmscan.args, stderr=stderr
+        )
+    return hits.get(record.id)
+
+
+def annotateBatch(
+    index,
+    tmpdir,
+    hmmerbin,
+    model,
+    cores,
+    chunks,
+    engine,
+    descriptions,
+    ordered,
+    cache,
+    resume,
+    newPool,
+):
+    if chunks is None:
+        chunks = cores
+    # every run gets its own scratch directory so runs sharing a working directory never collide
+    workDir = tempfile.mkdtemp(prefix="annotateTranscriptome.", dir=tmpdir)
+    try:
+        yield from annotateChunks(
+            index,
+            workDir,
+            hmmerbin,
+            model,
+            cores,
+            chunks,
+            engine,
+            descriptions,
+            ordered,
+            cache,
+            resume,
+            newPool,
+        )
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+        if cache is not None:
+            cache.close()
+
+
+def annotateChunks(
+    index,
+    workDir,
+    hmmerbin,
+    model,
+    cores,
+    chunks,
+    engine,
+    descriptions,
+    ordered,
+    cache,
+    resume,
+    newPool,
+):
+    # chunks hold consecutive contigs with about the same number of bases each, so they take about as long
+    chunkOf = balancedBlocks(index.lengths(), chunks)
+    # translate every contig first and write contiguous blocks of contigs and their ORFs to chunk files,
+    # only the first copy of every distinct ORF without cached hits goes to the file that is actually scanned
+    chunkPaths = []
+    firstChunk = {}  # protein hash -> chunk that scans (or looks up) that ORF
+    needs = []  # per chunk, the earlier chunks scanning ORFs it shares
+    contigFile = orfFile = scanFile = None
+    with newPool() as pool:
+        translatedRanges = pool.imap(translateRanges, ([r] for r in index.ranges(64)))
+        translated = (pair for pairs in translatedRanges for pair in pairs)
+        n = 0
+        while True:
+            with METRICS.timer("translate"):
+                pair = next(translated, None)
+            if pair is None:
+                break
+            sequence, translatedSequence = pair
+            writeStart = time.perf_counter()
+            if n == 0 or chunkOf[n] != chunkOf[n - 1]:
+                if contigFile is not None:
+                    contigFile.close()
+                    orfFile.close()
+                    scanFile.close()
+                chunkPath = os.path.join(workDir, f"chunk{len(chunkPaths)}")
+                chunkPaths.append(chunkPath)
+                needs.append(set())
+                contigFile = open(f"{chunkPath}.fna", "w")
+                orfFile = open(f"{chunkPath}.faa", "w")
+                scanFile = open(f"{chunkPath}.fasta", "w")
+            SeqIO.write(sequence, contigFile, "fasta-2line")
+            if translatedSequence is not None:
+                orfRecord = SeqRecord(
+                    translatedSequence, id=sequence.id, name="", description=""
+                )
+                SeqIO.write(orfRecord, orfFile, "fasta-2line")
+                digest = proteinHash(translatedSequence)
+                if digest in firstChunk:
+                    METRICS.count("duplicate orfs")
+                    needs[-1].add(firstChunk[digest])
+                else:
+                    firstChunk[digest] = len(chunkPaths) - 1
+                    METRICS.count("distinct orfs")
+                    if not resume or cache.get(translatedSequence) is MISSING:
+                        # named after its hash so the hits can go to every contig sharing it
+                        scanRecord = SeqRecord(
+                            translatedSequence, id=digest, name="", description=""
+                        )
+                        SeqIO.write(scanRecord, scanFile, "fasta-2line")
+                    else:
+                        METRICS.count("cache hits")
+                METRICS.count("orfs")
+            else:
+                METRICS.count("no orf")
+            METRICS.count("contigs")
+            METRICS.add("chunk io", time.perf_counter() - writeStart)
+            n += 1
+    if contigFile is not None:
+        contigFile.close()
+        orfFile.close()
+        scanFile.close()
+    if not chunkPaths:
+        return
+    if engine == "pyhmmer":
+        # read and optimize the profiles once, every chunk is scanned against the same block
+        with METRICS.timer("load profiles"):
+            model = pyhmmerEngine.ProfileDatabase(model)
+    # run one multi-threaded hmmer process (or pyhmmer scan) per chunk, as many chunks at once as there are cores
+    scanCpus = max(1, cores // len(chunkPaths))
+    scanArgs = [
+        (hmmerbin, model, chunkPath, scanCpus, engine, descriptions)
+        for chunkPath in chunkPaths
+    ]
+    scanned = {}  # protein hash -> hits, from every chunk scanned so far
+    results = {}  # protein hash -> hits, for every ORF that already got its row
+    finished = set()
+    waiting = []  # scanned chunks sharing ORFs with a chunk that is still being scanned
+    with ThreadPool(min(len(scanArgs), cores)) as pool:
+        scan = pool.imap if ordered else pool.imap_unordered
+        for chunkPath, hits, seconds in scan(scanChunk, scanArgs):
+            METRICS.add(engine, seconds)
+            scanned.update(hits)
+            finished.add(chunkPaths.index(chunkPath))
+            waiting.append(chunkPaths.index(chunkPath))
+            ready = [chunk for chunk in waiting if needs[chunk] <= finished]
+            waiting = [chunk for chunk in waiting if chunk not in ready]
+            for chunk in ready:
+                yield from chunkRows(chunkPaths[chunk], scanned, results, cache, resume)
+
+
+def chunkRows(chunkPath, scanned, results, cache, resume):
+    rowsStart = time.perf_counter()
+    # map the hits back to the chunk's contigs and build the same rows as searchProtein
+    orfs = SeqIO.parse(f"{chunkPath}.faa", "fasta")
+    orf = next(orfs, None)
+    for sequence in SeqIO.parse(f"{chunkPath}.fna", "fasta"):
+        translatedSequence = None
+        result = None
+        if orf is not None and orf.id == sequence.id:
+            translatedSequence = orf.seq
+            digest = proteinHash(translatedSequence)
+            result = results.get(digest, MISSING)
+            if result is MISSING:
+                result = cache.get(translatedSequence) if resume else MISSING
+                if result is MISSING:
+                    result = scanned.pop(digest, None)
+                    if cache is not None:
+                        cache.put(translatedSequence, result)
+                results[digest] = result
+            orf = next(orfs, None)
+        yield buildRow(sequence, translatedSequence, result)
+    for suffix in [".fna", ".faa", ".fasta"]:
+        os.remove(f"{chunkPath}{suffix}")
+    # includes the time the rows spent being written by the caller
+    METRICS.add("chunk rows", time.perf_counter() - rowsStart)
+
+
+def scanChunk(args):
+    hmmerbin, hmmfile, chunkPath, cpus, engine, descriptions = args
+    orfPath = f"{chunkPath}.fasta"
+    start = time.perf_counter()
+    if os.path.getsize(orfPath) == 0:
+        return chunkPath, {}, 0.0
+    if engine == "pyhmmer":
+        # hmmfile is the ProfileDatabase shared by all chunks, its hits look like hmmscan's table rows
+        hits = collectHits(hmmfile.scan(orfPath, cpus), "hmmscan", descriptions)
+        return chunkPath, hits, time.perf_counter() - start
+    scanPath = os.path.join(hmmerbin, engine)
+    cmd = [scanPath, "--notextw", "--cpu", str(cpus)]
+    if engine == "hmmsearch":
+        # E-values scale with the number of comparisons, use hmmscan's (the number of profiles)
+        cmd += ["-Z", str(len(descriptions))]
+    cmd += ["-o", os.devnull, "--domtblout", STDOUT, hmmfile, orfPath]
+    # parse the domain table while hmmer is still writing it
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True) as proc:
+        hits = collectHits(parseDomtblout(proc.stdout), engine, descriptions)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return chunkPath, hits, time.perf_counter() - start
+
+
+def collectHits(domainHits, engine, descriptions):
+    # --domtblout has one line per domain, keep one hit per (contig, model) like the per-sequence hit list
+    hits = {}
+    for hit in domainHits:
+        if engine == "hmmscan":
+            model = hit.target
+            contig = hit.query
+            description = hit.description
+        else:
+            # hmmsearch swaps target and query and describes the sequence, not the profile
+            model = hit.query
+            contig = hit.target
+            # stamps written before descriptions defaulted to "-" still hold ""
+            description = descriptions.get(model) or "-"
+        # a contig with only reported (not included) hits still gets an empty hit list
+        contigHits = hits.setdefault(contig, {})
+        if hit.fullE > INCLUSION_E:
+            continue
+        if model not in contigHits:
+            contigHits[model] = {
+                "full_e": hit.fullE,
+                "full_score": hit.fullScore,
+                "full_bias": hit.fullBias,
+                "model": model,
+                "description": description,
+                "domains": [],
+            }
+        contigHits[model]["domains"].append((hit.envFrom, hit.envTo))
+    # hmmsearch groups rows by profile, rank every contig's hits the way hmmscan lists them
+    return {
+        contig: sorted(
+            contigHits.values(), key=lambda x: (x["full_e"], -x["full_score"])
+        )
+        for contig, contigHits in hits.items()
+    }
+
+
+def translateRanges(ranges):
+    # find and translate the first ORF of every contig in the ranges in one vectorized pass
+    with METRICS.timer("read"):
+        sequences = [sequence for r in ranges for sequence in readRange(r)]
+    minLength = WORKER_CONFIG["orfMinLength"]
+    with METRICS.timer("orf"):
+        orfs = orfEngine.translateORFs(
+            [sequence.seq for sequence in sequences], minLength
+        )
+    return [
+        (sequence, proteins[0] if proteins else None)
+        for sequence, proteins in zip(sequences, orfs)
+    ]
+
+
+def translateTask(task):
+    i, ranges = task
+    with profiled(METRICS, PROFILE_WORKER):
+        pairs = translateRanges(ranges)
+    return i, pairs, METRICS.drain()
+
+
+def searchProtein(task):
+    # the domain hits of one distinct ORF, named after the first contig that translated to it
+    digest, contig, length, translatedSequence = task
+    with profiled(METRICS, PROFILE_WORKER):
+        start = time.perf_counter()
+        cache = workerCache()
+        resume = WORKER_CONFIG["resume"]
+        with METRICS.timer("cache"):
+            result = cache.get(translatedSequence) if resume else MISSING
+        if result is MISSING:
+            orfRecord = SeqRecord(translatedSequence, id=contig, name=contig)
+            with METRICS.timer("hmmscan"):
+                result = findDomains(orfRecord)
+            if result is TIMED_OUT:
+                METRICS.timeout(contig)
+                result = None
+            elif cache is not None:
+                with METRICS.timer("cache"):
+                    cache.put(translatedSequence, result)
+        else:
+            METRICS.count("cache hits")
+        METRICS.contig(contig, length, time.perf_counter() - start)
+    return digest, result, METRICS.drain()
+
+
+def workerCache():
+    # None when the run keeps no result cache
+    global WORKER_CACHE
+    if WORKER_CACHE is None and WORKER_CONFIG["resultCache"] is not None:
+        WORKER_CACHE = ResultCache(*WORKER_CONFIG["resultCache"])
+        # closed when the worker exits, so SQLite can checkpoint and remove its -wal and -shm files
+        Finalize(WORKER_CACHE, WORKER_CACHE.close, exitpriority=10)
+    return WORKER_CACHE
+
+
+def buildRow(sequence, translatedSequence, result):
     noORF = False
     noFeatures = False
-    result = None
     names = None
     descriptions = None
-    translatedSequence = None
-    if len(orfs):
-        translatedSequence = orfs[0].translate()
-        contig = sequence.id
-        orfRecord = SeqRecord(translatedSequence, id=contig, name=contig)
-        result = findDomains(orfRecord)
+    if translatedSequence is not None:
         if result is None:
             noFeatures = True
         else:
@@ -216,4 +992,4 @@ def processSequence(sequence):
 
 
 if __name__ == "__main__":
-    annotateSequences()
+    cli()
@@ -0,0 +1,180 @@
+import csv
+import json
+import time
+import heapq
+import pstats
+import cProfile
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+
+SLOWEST = 25  # number of slowest contigs kept in the summary
+TIMED_OUT_IDS = 1000  # at most this many timed out contig IDs are listed
+PERCENTILES = [50, 90, 99]
+
+
+class RunMetrics:
+    # stage timers, counters and the slowest contigs seen by one process, pool workers drain theirs
+    # after every task and the main process merges them into its own
+    def __init__(self):
+        self.stages = {}
+        self.counters = Counter()
+        self.slowest = []  # min-heap of (seconds, contig, length)
+        self.timedOut = []
+        self.profiles = []  # raw cProfile stats of profiled tasks, not merged yet
+        self.profileStats = None
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        self.stages.setdefault(stage, array("d")).append(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def contig(self, contig, length, seconds):
+        self.keepSlowest((seconds, contig, length))
+
+    def keepSlowest(self, item):
+        if len(self.slowest) < SLOWEST:
+            heapq.heappush(self.slowest, item)
+        elif item > self.slowest[0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def timeout(self, contig):
+        self.count("timeouts")
+        if len(self.timedOut) < TIMED_OUT_IDS:
+            self.timedOut.append(contig)
+
+    def addProfile(self, stats):
+        self.profiles.append(stats)
+
+    def merge(self, other):
+        for stage, seconds in other.stages.items():
+            self.stages.setdefault(stage, array("d")).extend(seconds)
+        self.counters.update(other.counters)
+        for item in other.slowest:
+            self.keepSlowest(item)
+        self.timedOut += other.timedOut[: TIMED_OUT_IDS - len(self.timedOut)]
+        self.profiles += other.profiles
+        self.mergeProfiles()
+
+    def mergeProfiles(self):
+        # fold raw profiles into one pstats.Stats as they arrive so they never pile up
+        for stats in self.profiles:
+            if self.profileStats is None:
+                self.profileStats = pstats.Stats(ProfileSnapshot(stats))
+            else:
+                self.profileStats.add(ProfileSnapshot(stats))
+        self.profiles = []
+
+    def drain(self):
+        # hand everything collected so far to the caller and start over
+        drained = RunMetrics()
+        drained.stages = self.stages
+        drained.counters = self.counters
+        drained.slowest = self.slowest
+        drained.timedOut = self.timedOut
+        drained.profiles = self.profiles
+        self.__init__()
+        return drained
+
+    def summary(self, wallSeconds):
+        stages = {}
+        for stage, seconds in self.stages.items():
+            seconds = np.frombuffer(seconds, dtype=np.float64)
+            stages[stage] = {
+                "calls": len(seconds),
+                "total": float(seconds.sum()),
+                "mean": float(seconds.mean()),
+                **{
+                    f"p{p}": float(v)
+                    for p, v in zip(PERCENTILES, np.percentile(seconds, PERCENTILES))
+                },
+                "max": float(seconds.max()),
+            }
+        # contigs with an ORF per distinct ORF, duplicate translations are only searched once
+        distinct = self.counters["distinct orfs"]
+        return {
+            "wall_seconds": wallSeconds,
+            "stages": stages,
+            "counters": dict(self.counters),
+            "orf_collapse_ratio": (
+                self.counters["orfs"] / distinct if distinct else None
+            ),
+            "slowest_contigs": [
+                {"contig": contig, "length": length, "seconds": seconds}
+                for seconds, contig, length in sorted(self.slowest, reverse=True)
+            ],
+            "timed_out_contigs": self.timedOut,
+        }
+
+    def write(self, path, wallSeconds):
+        # JSON unless the path ends in .csv, the CSV has one row per stage, counter and slow contig
+        summary = self.summary(wallSeconds)
+        if not path.endswith(".csv"):
+            with open(path, "w") as f:
+                json.dump(summary, f, indent=2)
+            return
+        columns = ["calls", "total", "mean"] + [f"p{p}" for p in PERCENTILES] + ["max"]
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["section", "name", "value"] + columns[1:])
+            writer.writerow(["run", "wall_seconds", wallSeconds])
+            writer.writerow(
+                ["run", "orf_collapse_ratio", summary["orf_collapse_ratio"]]
+            )
+            for stage, values in summary["stages"].items():
+                writer.writerow(["stage", stage] + [values[c] for c in columns])
+            for name, value in summary["counters"].items():
+                writer.writerow(["counter", name, value])
+            for contig in summary["slowest_contigs"]:
+                writer.writerow(
+                    [
+                        "slowest contig",
+                        contig["contig"],
+                        contig["length"],
+                        contig["seconds"],
+                    ]
+                )
+            for contig in summary["timed_out_contigs"]:
+                writer.writerow(["timed out", contig])
+
+    def writeProfile(self, path):
+        self.mergeProfiles()
+        if self.profileStats is None:
+            return False
+        self.profileStats.dump_stats(path)
+        return True
+
+
+class ProfileSnapshot:
+    # lets pstats.Stats load a stats dict that came from another process
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+@contextmanager
+def profiled(metrics, enabled):
+    if not enabled:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.create_stats()
+        metrics.addProfile(profile.stats)
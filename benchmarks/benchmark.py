@@ -0,0 +1,386 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+import click
+
+import synthetic
+
+# python benchmarks/benchmark.py run --suite annotate,rlcd,images --contigs 2000 --results benchmarks/results.jsonl
+# every pipeline runs as its own process so its peak RSS can be read back with wait4
+# python benchmarks/benchmark.py crosscheck --hmmerbin /lab/solexa_reddien/Patrick/tools/hmmer-3.3.2/bin
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SUITES = ["annotate", "rlcd", "images"]
+# three small profiles built with hmmbuild and the proteins they were built from
+TEST_PROFILES = os.path.join(REPO, "benchmarks", "data", "testProfiles")
+
+
+@click.group()
+def benchmark():
+    pass
+
+
+@benchmark.command()
+@click.option(
+    "--suite",
+    type=str,
+    default=",".join(SUITES),
+    help="Comma-separated pipelines to benchmark (annotate, rlcd, images).",
+)
+@click.option(
+    "--workdir",
+    type=str,
+    default=None,
+    help="Where to generate the synthetic inputs (defaults to a temporary directory that is removed afterwards).",
+)
+@click.option("--contigs", type=int, default=2000, help="Number of synthetic contigs.")
+@click.option(
+    "--contig_length", type=int, default=1500, help="Mean synthetic contig length."
+)
+@click.option(
+    "--orf_density",
+    type=float,
+    default=0.8,
+    help="Fraction of synthetic contigs that carry an ORF.",
+)
+@click.option(
+    "--hmmerbin",
+    type=str,
+    default=None,
+    help="Real hmmer bin directory to benchmark against (defaults to fake hmmer scripts).",
+)
+@click.option(
+    "--model",
+    type=str,
+    default=None,
+    help="Small real HMM file (ex. a Pfam subset) to use with --hmmerbin.",
+)
+@click.option(
+    "--hmm_delay",
+    type=float,
+    default=0.0,
+    help="Seconds the fake hmmscan spends per sequence.",
+)
+@click.option(
+    "--rlcd_rows", type=int, default=20000, help="Rows of the synthetic RLCD table."
+)
+@click.option(
+    "--rlcd_genes", type=int, default=500, help="Genes looked up in the RLCD."
+)
+@click.option("--stacks", type=int, default=4, help="Number of synthetic image stacks.")
+@click.option(
+    "--stack_shape",
+    type=str,
+    default="3,20,1024,1024",
+    help="Synthetic stack shape as 'channels,z,y,x'.",
+)
+@click.option(
+    "-c",
+    "--cores",
+    type=int,
+    default=os.cpu_count(),
+    help="Cores given to every pipeline.",
+)
+@click.option("--repeat", type=int, default=1, help="Times each pipeline is run.")
+@click.option(
+    "--results",
+    type=str,
+    default=None,
+    help="Append one JSON line per measurement to this file to track regressions over commits.",
+)
+def run(
+    suite,
+    workdir,
+    contigs,
+    contig_length,
+    orf_density,
+    hmmerbin,
+    model,
+    hmm_delay,
+    rlcd_rows,
+    rlcd_genes,
+    stacks,
+    stack_shape,
+    cores,
+    repeat,
+    results,
+):
+    suites = [s.strip() for s in suite.split(",") if s.strip()]
+    for s in suites:
+        if s not in SUITES:
+            raise click.BadParameter(f"unknown suite '{s}'", param_hint="--suite")
+    keep = workdir is not None
+    workdir = workdir or tempfile.mkdtemp(prefix="annotateBenchmark.")
+    os.makedirs(workdir, exist_ok=True)
+    commit = gitCommit()
+    measurements = []
+    try:
+        if "annotate" in suites:
+            measurements += benchAnnotate(
+                workdir,
+                contigs,
+                contig_length,
+                orf_density,
+                hmmerbin,
+                model,
+                hmm_delay,
+                cores,
+                repeat,
+            )
+        if "rlcd" in suites:
+            measurements += benchRLCD(workdir, rlcd_rows, rlcd_genes, repeat)
+        if "images" in suites:
+            measurements += benchImages(workdir, stacks, stack_shape, cores, repeat)
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print(
+        f"{'pipeline':<28}{'seconds':>10}{'items/s':>12}{'MB/s':>10}{'peak RSS MB':>14}"
+    )
+    for m in measurements:
+        print(
+            f"{m['pipeline']:<28}{m['seconds']:>10.2f}{m['items_per_second']:>12.1f}"
+            f"{m['mb_per_second']:>10.2f}{fmtRss(m['peak_rss_mb']):>14}"
+        )
+    if results is not None:
+        with open(results, "a") as f:
+            for m in measurements:
+                f.write(json.dumps({"commit": commit, "time": time.time(), **m}) + "\n")
+
+
+def benchAnnotate(
+    workdir,
+    contigs,
+    contigLength,
+    orfDensity,
+    hmmerbin,
+    model,
+    hmmDelay,
+    cores,
+    repeat,
+):
+    fasta = os.path.join(workdir, "transcriptome.fasta")
+    size = synthetic.writeTranscriptome(fasta, contigs, contigLength, orfDensity)
+    if hmmerbin is None:
+        hmmerbin = os.path.join(workdir, "hmmer")
+        model = synthetic.writeFakeHmmer(hmmerbin, hmmDelay)
+    script = os.path.join(REPO, "annotateTranscriptome.py")
+    base = [sys.executable, script, "-i", fasta, "-h", hmmerbin, "-m", model]
+    base += ["-c", str(cores)]
+    modes = {
+        "annotate per-record": [],
+        "annotate batch": ["--batch", "True"],
+    }
+    measurements = []
+    for name, extra in modes.items():
+        for i in range(repeat):
+            outfile = os.path.join(workdir, f"annotate{i}.tsv")
+            # a fresh result cache every time, otherwise later runs only measure cache hits
+            cmd = base + ["-o", outfile, "--result_cache", f"{outfile}.sqlite"]
+            measurements.append(measure(name, cmd + extra, contigs, size, workdir))
+            os.remove(f"{outfile}.sqlite")
+    return measurements
+
+
+def benchRLCD(workdir, rows, genes, repeat):
+    database = os.path.join(workdir, "rlcd.xlsx")
+    genesPath = os.path.join(workdir, "genes.tsv")
+    size = synthetic.writeRLCD(database, genesPath, rows, genes)
+    script = os.path.join(REPO, "searchRLCD.py")
+    measurements = []
+    for i in range(repeat):
+        cacheDir = os.path.join(workdir, f"rlcd{i}.columns")
+        cmd = [sys.executable, script, "-g", genesPath, "-d", database]
+        cmd += ["-o", os.path.join(workdir, "rlcd.tsv"), "--cache_dir", cacheDir]
+        # the first search builds the columnar snapshot, the second one reuses it
+        measurements.append(measure("rlcd search (cold)", cmd, genes, size, workdir))
+        measurements.append(measure("rlcd search (warm)", cmd, genes, size, workdir))
+    return measurements
+
+
+def benchImages(workdir, stacks, stackShape, cores, repeat):
+    measurements = []
+    for i in range(repeat):
+        outDir = os.path.join(workdir, f"images{i}")
+        cmd = [sys.executable, os.path.abspath(__file__), "images"]
+        cmd += ["--directory", outDir, "--stacks", str(stacks)]
+        cmd += ["--stack_shape", stackShape, "--cores", str(cores)]
+        channels, z, y, x = (int(n) for n in stackShape.split(","))
+        size = stacks * channels * z * y * x * 2
+        for stage in ["export", "strip"]:
+            measurements.append(
+                measure(
+                    f"images {stage}",
+                    cmd + ["--stage", stage],
+                    stacks * channels * z if stage == "export" else stacks * z,
+                    size if stage == "export" else stacks * z * y * x * 8,
+                    workdir,
+                )
+            )
+    return measurements
+
+
+@benchmark.command()
+@click.option(
+    "--hmmerbin",
+    required=True,
+    type=str,
+    help="hmmer bin directory with hmmscan and hmmpress.",
+)
+@click.option(
+    "--workdir",
+    type=str,
+    default=None,
+    help="Where to write the inputs and both outputs (defaults to a temporary directory that is removed afterwards).",
+)
+@click.option("--contigs", type=int, default=300, help="Number of synthetic contigs.")
+@click.option(
+    "-c",
+    "--cores",
+    type=int,
+    default=os.cpu_count(),
+    help="Cores given to both engines.",
+)
+def crosscheck(hmmerbin, workdir, contigs, cores):
+    # annotate the same contigs against the bundled test profiles with the hmmscan subprocess and with
+    # the in-process pyhmmer engine, both must give the same rows
+    keep = workdir is not None
+    workdir = workdir or tempfile.mkdtemp(prefix="annotateCrosscheck.")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        fasta = os.path.join(workdir, "transcriptome.fasta")
+        size = synthetic.writeDomainTranscriptome(
+            fasta, f"{TEST_PROFILES}.faa", contigs
+        )
+        script = os.path.join(REPO, "annotateTranscriptome.py")
+        outputs = {}
+        for engine in ["hmmscan", "pyhmmer"]:
+            # every engine presses its own copy of the profiles
+            model = os.path.join(workdir, f"{engine}.hmm")
+            shutil.copyfile(f"{TEST_PROFILES}.hmm", model)
+            outputs[engine] = os.path.join(workdir, f"{engine}.tsv")
+            cmd = [sys.executable, script, "-i", fasta, "-o", outputs[engine]]
+            cmd += ["-h", hmmerbin, "-m", model, "-c", str(cores)]
+            cmd += ["--engine", engine, "--ordered", "True"]
+            m = measure(f"annotate {engine}", cmd, contigs, size, workdir)
+            print(f"{engine:<10}{m['seconds']:>8.2f} s")
+        with open(outputs["hmmscan"]) as f:
+            expected = f.readlines()
+        with open(outputs["pyhmmer"]) as f:
+            found = f.readlines()
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    differences = [(e, p) for e, p in zip(expected, found) if e != p]
+    if len(expected) != len(found) or differences:
+        for e, p in differences[:5]:
+            print(f"hmmscan: {e.rstrip()}\npyhmmer: {p.rstrip()}")
+        raise click.ClickException(
+            f"{len(differences)} of {len(expected) - 1} rows differ "
+            f"({len(expected)} and {len(found)} lines)"
+        )
+    print(f"all {len(expected) - 1} rows match")
+
+
+@benchmark.command(hidden=True)
+@click.option("--directory", required=True, type=str)
+@click.option("--stacks", type=int, default=4)
+@click.option("--stack_shape", type=str, default="3,20,1024,1024")
+@click.option("--cores", type=int, default=os.cpu_count())
+@click.option("--stage", type=click.Choice(["export", "strip"]), required=True)
+def images(directory, stacks, stack_shape, cores, stage):
+    # one image stage on synthetic data, run in its own process by `run`
+    from multiprocessing.pool import ThreadPool
+
+    sys.path.insert(0, os.path.join(REPO, "forCecilia"))
+    import lifExport
+    import ilastik
+    from manifest import Manifest
+
+    channels, z, y, x = (int(n) for n in stack_shape.split(","))
+    if stage == "export":
+        outDirs = {
+            "tiff": os.path.join(directory, "tiff"),
+            "h5": os.path.join(directory, "h5"),
+        }
+        for outDir in outDirs.values():
+            os.makedirs(outDir, exist_ok=True)
+        tasks = [
+            (synthetic.SyntheticImage(channels, z, y, x, seed=n), f"stack{n}")
+            for n in range(stacks)
+        ]
+        with ThreadPool(max(1, min(cores, stacks))) as pool:
+            pool.map(
+                lambda task: lifExport.exportImage(
+                    task[0], task[1], outDirs, (1, 256, 256), {}
+                ),
+                tasks,
+            )
+    else:
+        tiffDir = os.path.join(directory, "tiff_probability_maps")
+        synthetic.writeProbabilityMaps(tiffDir, stacks * z, y, x)
+        ilastik.removeBackgroundProbability(
+            tiffDir,
+            os.path.join(directory, "fmt_tiff_probability_maps"),
+            2,
+            "EdU",
+            Manifest(directory, force=True),
+            cores,
+            "none",
+        )
+
+
+def measure(pipeline, cmd, items, inputBytes, workdir):
+    # the pipeline's own output (progress bars, errors) goes to a log in the working directory
+    logPath = os.path.join(workdir, "benchmark.log")
+    start = time.perf_counter()
+    with open(logPath, "a") as log:
+        log.write(f"# {pipeline}: {' '.join(cmd)}\n")
+        log.flush()
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+        peakRss = None
+        if hasattr(os, "wait4"):
+            # ru_maxrss is the largest resident set of the process or any of its children, in KB on Linux
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            peakRss = usage.ru_maxrss / 1024
+        else:
+            proc.wait()
+    seconds = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise click.ClickException(
+            f"{pipeline} exited with code {proc.returncode}, see {logPath}"
+        )
+    return {
+        "pipeline": pipeline,
+        "seconds": seconds,
+        "items": items,
+        "items_per_second": items / seconds,
+        "mb_per_second": inputBytes / 2**20 / seconds,
+        "peak_rss_mb": peakRss,
+    }
+
+
+def fmtRss(rss):
+    return "n/a" if rss is None else f"{rss:.0f}"
+
+
+def gitCommit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    benchmark()
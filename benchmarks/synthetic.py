@@ -0,0 +1,196 @@
+import os
+import re
+import sys
+import stat
+
+import numpy as np
+import pandas as pd
+import tifffile
+from Bio import SeqIO
+from Bio.Data.CodonTable import standard_dna_table
+
+# synthetic inputs for benchmark.py, every generator is seeded so runs are comparable
+
+NO_START = re.compile("ATG|CAT")  # ATG on either strand
+STOPS = ["TAA", "TAG", "TGA"]
+SENSE_CODONS = [
+    a + b + c
+    for a in "ACGT"
+    for b in "ACGT"
+    for c in "ACGT"
+    if a + b + c not in STOPS + ["ATG"]
+]
+
+CODONS = {}  # amino acid -> its codons
+for codon, aa in standard_dna_table.forward_table.items():
+    CODONS.setdefault(aa, []).append(codon)
+AMINO_ACIDS = sorted(CODONS)
+
+FAKE_SCAN = """#!{python}
+# stands in for hmmscan/hmmsearch: reads the sequence names, sleeps per sequence and reports fixed hits
+import sys, time, zlib
+args = sys.argv[1:]
+seqfile = args[-1]
+lines = sys.stdin if seqfile == "-" else open(seqfile)
+names = [l[1:].split()[0] for l in lines if l.startswith(">")]
+time.sleep({delay} * len(names))
+with open(args[args.index("--domtblout") + 1], "w") as f:
+    f.write("# fake domain table\\n")
+    for n in names:
+        if zlib.crc32(n.encode()) % 3 == 0:
+            continue
+        {row}
+"""
+SCAN_ROW = 'f.write(f"PK_Tyr  PF07714.1  259 {n} - 300 1e-20 70.1 0.1 1 1 1e-10 1e-10 30.0 0.1 1 100 5 105 3 107 0.9 Protein tyrosine kinase\\n")'
+SEARCH_ROW = 'f.write(f"{n}  -  259 PK_Tyr PF07714.1 300 1e-20 70.1 0.1 1 1 1e-10 1e-10 30.0 0.1 1 100 5 105 3 107 0.9 -\\n")'
+FAKE_PRESS = """#!/bin/sh
+for s in h3m h3i h3f h3p; do touch "$2.$s"; done
+"""
+FAKE_MODEL = """HMMER3/f [3.3.2 | Nov 2020]
+NAME  PK_Tyr
+ACC   PF07714.1
+DESC  Protein tyrosine kinase
+//
+"""
+
+
+def writeTranscriptome(path, contigs, meanLength, orfDensity, seed=0):
+    # random contigs without any start codon, a fraction of them gets one ORF of a third of its length
+    rng = np.random.default_rng(seed)
+    lengths = np.maximum(100, rng.normal(meanLength, meanLength / 3, contigs)).astype(
+        int
+    )
+    with open(path, "w") as f:
+        for i, length in enumerate(lengths):
+            sequence = randomBases(rng, length)
+            if rng.random() < orfDensity:
+                codons = rng.choice(SENSE_CODONS, max(25, length // 9))
+                orf = "ATG" + "".join(codons) + rng.choice(STOPS)
+                at = int(rng.integers(0, max(1, length - len(orf))))
+                sequence = sequence[:at] + orf + sequence[at + len(orf) :]
+            f.write(f">contig{i} len={len(sequence)}\n")
+            for j in range(0, len(sequence), 60):
+                f.write(sequence[j : j + 60] + "\n")
+    return os.path.getsize(path)
+
+
+def writeDomainTranscriptome(path, proteinsPath, contigs, seed=0):
+    # contigs whose ORFs carry one to three mutated copies of the given domain proteins, or a random protein,
+    # so a real HMM database built from those proteins gets a mix of single, repeated and missing hits
+    rng = np.random.default_rng(seed)
+    proteins = [str(r.seq) for r in SeqIO.parse(proteinsPath, "fasta")]
+    with open(path, "w") as f:
+        for i in range(contigs):
+            if rng.random() < 0.2:
+                protein = "".join(rng.choice(AMINO_ACIDS, int(rng.integers(40, 200))))
+            else:
+                picked = rng.choice(proteins, int(rng.integers(1, 4)))
+                protein = "".join(mutate(rng, p, 0.1) for p in picked)
+            orf = "ATG" + "".join(rng.choice(CODONS[aa]) for aa in protein)
+            orf += rng.choice(STOPS)
+            flank = int(rng.integers(20, 300))
+            sequence = randomBases(rng, flank) + orf + randomBases(rng, flank)
+            f.write(f">contig{i} len={len(sequence)}\n")
+            for j in range(0, len(sequence), 60):
+                f.write(sequence[j : j + 60] + "\n")
+    return os.path.getsize(path)
+
+
+def mutate(rng, protein, rate):
+    residues = np.array(list(protein))
+    changed = rng.random(len(residues)) < rate
+    residues[changed] = rng.choice(AMINO_ACIDS, changed.sum())
+    return "".join(residues)
+
+
+def randomBases(rng, length):
+    sequence = "".join(rng.choice(list("ACGT"), length))
+    # knock out every start codon so only the inserted ORFs count
+    while NO_START.search(sequence):
+        sequence = NO_START.sub(
+            lambda m: "ACG" if m.group() == "ATG" else "CCT", sequence
+        )
+    return sequence
+
+
+def writeFakeHmmer(binDir, delay=0.0):
+    # hmmscan, hmmsearch and hmmpress look-alikes plus a one-profile model, delay is seconds per sequence
+    os.makedirs(binDir, exist_ok=True)
+    python = os.path.realpath(sys.executable)
+    scripts = {
+        "hmmscan": FAKE_SCAN.format(python=python, delay=delay, row=SCAN_ROW),
+        "hmmsearch": FAKE_SCAN.format(python=python, delay=delay, row=SEARCH_ROW),
+        "hmmpress": FAKE_PRESS,
+    }
+    for name, script in scripts.items():
+        path = os.path.join(binDir, name)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    modelPath = os.path.join(binDir, "fake.hmm")
+    with open(modelPath, "w") as f:
+        f.write(FAKE_MODEL)
+    return modelPath
+
+
+def writeRLCD(databasePath, genesPath, rows, genes, seed=0):
+    rng = np.random.default_rng(seed)
+    ddIDs = rng.integers(1, 40000, rows)
+    dates = pd.Timestamp("2015-01-01") + pd.to_timedelta(
+        rng.integers(0, 3000, rows), unit="D"
+    )
+    db = pd.DataFrame(
+        {
+            "Reddien Lab Construct Database Index Name": [
+                f"RLCD{i}" for i in range(rows)
+            ],
+            "Location": [f"box {i // 81} well {i % 81}" for i in range(rows)],
+            "Plasmid Backbone": rng.choice(["pPR-T4P", "pPR244", "pJC53.2"], rows),
+            "Date Record Created": dates,
+            "Date Record Modified": dates,
+            "Associated Contig": [f"dd_Smed_v6_{d}_0_1" for d in ddIDs],
+            "Forward Primer": [randomBases(rng, 20) for _ in range(rows)],
+            "Reverse Primer": [randomBases(rng, 20) for _ in range(rows)],
+            "Gene Name": [f"smed-gene{d}" for d in ddIDs],
+        }
+    )
+    db.to_excel(databasePath, index=False)
+    picked = rng.choice(ddIDs, genes)
+    byName = rng.random(genes) < 0.3
+    pd.DataFrame(
+        {
+            "Label": [f"gene{i}" for i in range(genes)],
+            "dd ID": [None if n else str(d) for d, n in zip(picked, byName)],
+            "Name": [f"smed-gene{d}" for d in picked],
+        }
+    ).to_csv(genesPath, sep="\t", index=False)
+    return os.path.getsize(databasePath)
+
+
+class SyntheticImage:
+    # looks like a readlif LifImage to lifExport: dims, channels, bit_depth and get_frame
+    def __init__(self, channels, z, y, x, seed=0):
+        self.channels = channels
+        self.dims = type("Dims", (), {"x": x, "y": y, "z": z, "t": 1, "m": 1})
+        self.bit_depth = (12,) * channels
+        rng = np.random.default_rng(seed)
+        # a few distinct planes are cycled so generating data does not dominate the timing
+        self.planes = rng.integers(0, 4096, (4, y, x), dtype=np.uint16)
+
+    def get_frame(self, z=0, t=0, c=0, m=0):
+        return self.planes[(z + c) % len(self.planes)]
+
+
+def writeProbabilityMaps(directory, maps, y, x, name="EdU", channel=2, seed=0):
+    # ilastik-style two-class probability tiffs (y, x, class) for the background stripping stage
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    probability = rng.random((y, x, 2), dtype=np.float32)
+    for i in range(maps):
+        tifffile.imwrite(
+            os.path.join(
+                directory, f"stack{i}_{channel}_{i:02d}_{name}_probability.tiff"
+            ),
+            probability,
+        )
+    return maps * probability.nbytes
@@ -0,0 +1,177 @@
+import io
+import os
+import copy
+import mmap
+
+from Bio import SeqIO
+
+
+class FastaIndex:
+    # samtools-style .fai index (name, length, offset, line bases, line width) plus the byte offset of each header
+    def __init__(self, path):
+        self.path = path
+        self.faiPath = f"{path}.fai"
+        self.size = os.path.getsize(path)
+        self.entries = None
+        if os.path.exists(self.faiPath) and os.path.getmtime(
+            self.faiPath
+        ) >= os.path.getmtime(path):
+            self.entries, self.starts = readFai(self.faiPath)
+        if self.entries is None or not headersAt(path, self.starts):
+            # no index yet, or one whose record starts miss a header (blank lines between records)
+            self.entries, self.starts, regular = buildIndex(path)
+            # irregular line widths or blank lines cannot be described by a .fai, keep that index in memory only
+            if regular:
+                try:
+                    writeFai(self.faiPath, self.entries)
+                except OSError:
+                    # a read-only directory, index again on the next run
+                    pass
+        self.positions = {entry[0]: i for i, entry in enumerate(self.entries)}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return (entry[0] for entry in self.entries)
+
+    def __getitem__(self, name):
+        i = self.positions[name]
+        return next(readRange((self.path, *self.recordRange(i, i + 1))))
+
+    def length(self, name):
+        return self.entries[self.positions[name]][1]
+
+    def lengths(self):
+        return [entry[1] for entry in self.entries]
+
+    def recordRange(self, start, stop):
+        # byte range holding records [start, stop)
+        end = self.starts[stop] if stop < len(self.starts) else self.size
+        return self.starts[start], end
+
+    def slice(self, start, stop):
+        return readRange((self.path, *self.recordRange(start, stop)))
+
+    def shard(self, i, n):
+        # an index of only the i-th (from 0) of n consecutive slices of the records, with about the same bases each
+        blocks = balancedBlocks(self.lengths(), n)
+        members = [k for k, block in enumerate(blocks) if block == i]
+        start = members[0] if members else 0
+        stop = members[-1] + 1 if members else 0
+        part = copy.copy(self)
+        part.size = self.recordRange(start, stop)[1] if members else 0
+        part.entries = self.entries[start:stop]
+        part.starts = self.starts[start:stop]
+        part.positions = {entry[0]: k for k, entry in enumerate(part.entries)}
+        return part
+
+    def ranges(self, recordsPerRange=1):
+        # (path, byte start, byte stop) tasks that workers can read on their own
+        return [
+            (self.path, *self.recordRange(i, min(i + recordsPerRange, len(self))))
+            for i in range(0, len(self), recordsPerRange)
+        ]
+
+
+def balancedBlocks(lengths, blocks):
+    # the block (0 to blocks - 1) of every record when consecutive records are split into blocks of equal bases
+    total = max(1, sum(lengths))
+    found = []
+    done = 0
+    for length in lengths:
+        found.append(min(blocks - 1, done * blocks // total))
+        done += length
+    return found
+
+
+def readRange(task):
+    path, start, stop = task
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(stop - start)
+    return SeqIO.parse(io.StringIO(data.decode()), "fasta")
+
+
+def headersAt(path, starts):
+    # True if every start points at a header line
+    if not starts:
+        return True
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return all(mm[start : start + 1] == b">" for start in starts)
+
+
+def buildIndex(path):
+    entries = []
+    starts = []
+    regular = True
+    if os.path.getsize(path) == 0:
+        return entries, starts, regular
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = mm.find(b">")
+        while start != -1:
+            headerEnd = mm.find(b"\n", start)
+            if headerEnd == -1:
+                headerEnd = len(mm)
+            name = mm[start + 1 : headerEnd].split(None, 1)[0].decode()
+            seqStart = headerEnd + 1
+            nextStart = mm.find(b"\n>", headerEnd)
+            seqEnd = len(mm) if nextStart == -1 else nextStart + 1
+            region = mm[seqStart:seqEnd].rstrip()
+            length = len(region) - region.count(b"\n") - region.count(b"\r")
+            lineEnd = region.find(b"\n")
+            if lineEnd == -1:
+                # a single line, its width still counts a \r\n line ending
+                ending = mm[seqStart + len(region) : seqStart + len(region) + 2]
+                lineWidth = len(region) + (2 if ending == b"\r\n" else 1)
+                lineBases = length
+            else:
+                lineWidth = lineEnd + 1
+                lineBases = lineEnd - region[:lineEnd].count(b"\r")
+            if regular and lineEnd != -1:
+                # every line but the last must be exactly lineBases long
+                lines = region.split(b"\n")
+                regular = (
+                    all(len(line) == lineWidth - 1 for line in lines[:-1])
+                    and len(lines[-1].rstrip(b"\r")) <= lineBases
+                )
+            entries.append((name, length, seqStart, lineBases, lineWidth))
+            starts.append(start)
+            start = -1 if nextStart == -1 else nextStart + 1
+    # a .fai derives every record's start from the end of the one before, which blank lines break
+    for entry, start in zip(entries, starts[1:]):
+        if sequenceEnd(entry) != start:
+            regular = False
+    return entries, starts, regular
+
+
+def readFai(faiPath):
+    entries = []
+    starts = []
+    with open(faiPath, "r") as f:
+        for line in f:
+            name, length, offset, lineBases, lineWidth = line.split("\t")[:5]
+            entry = (name, int(length), int(offset), int(lineBases), int(lineWidth))
+            # a record starts right after the previous record's sequence lines
+            if entries:
+                starts.append(sequenceEnd(entries[-1]))
+            else:
+                starts.append(0)
+            entries.append(entry)
+    return entries, starts
+
+
+def sequenceEnd(entry):
+    _, length, offset, lineBases, lineWidth = entry
+    if not lineBases:
+        return offset
+    full, rest = divmod(length, lineBases)
+    return offset + full * lineWidth + (rest + lineWidth - lineBases if rest else 0)
+
+
+def writeFai(faiPath, entries):
+    tmpPath = f"{faiPath}.tmp"
+    with open(tmpPath, "w") as f:
+        for entry in entries:
+            f.write("\t".join(str(x) for x in entry) + "\n")
+    os.replace(tmpPath, faiPath)
@@ -1,8 +1,15 @@
 import os
-import re
+import csv
+import time
+import subprocess
+from multiprocessing.pool import ThreadPool
 
 import click
 
+from manifest import Manifest
+
+# python batchTiffMacro.py --exec ImageJ-linux64 --macro count.ijm --directory C:\Users\Patrick\Desktop\Cecilia2Patrick --suffix _2_00_EdU_probability.tiff --suffix _1_00_17258_probability.tiff --workers 4 --per_process 10
+
 
 @click.command()
 @click.option(
@@ -20,37 +27,116 @@ import click
     required=True,
     help="""Directory containing 'tiff' folder.""",
 )
-def runMacro(exec, macro, directory):
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Run the macro on every pair, even those it already processed.",
+)
+@click.option(
+    "--output_suffix",
+    "outputSuffixes",
+    multiple=True,
+    help="File name ending of a result the macro writes next to the tiffs (<prefix><suffix>), repeat for each result. A pair runs again when one of its results is gone, without this option only the tiffs and the macro are tracked.",
+)
+@click.option(
+    "--suffix",
+    "suffixes",
+    multiple=True,
+    default=["_2_00_EdU_probability.tiff", "_1_00_17258_probability.tiff"],
+    help="File name ending of one channel, repeat for each channel (defaults to the EdU and 17258 probability maps).",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=2,
+    help="Number of Fiji processes running at once.",
+)
+@click.option(
+    "--per_process",
+    type=int,
+    default=1,
+    help="Number of prefixes handed to one Fiji process, joined by --separator (the macro must split getArgument() itself when this is above 1).",
+)
+@click.option(
+    "--separator",
+    type=str,
+    default=";",
+    help="Separator between the prefixes passed to one Fiji process.",
+)
+@click.option(
+    "--headless/--gui",
+    default=True,
+    help="Start Fiji with --headless (use --gui for macros that need a display).",
+)
+def runMacro(
+    exec,
+    macro,
+    directory,
+    force,
+    outputSuffixes,
+    suffixes,
+    workers,
+    per_process,
+    separator,
+    headless,
+):
     # raise an exception if the tiff input folder does not exist
     tiffDir = os.path.join(directory, "tiff")
     if not os.path.exists(tiffDir):
         raise Exception(f"Expected a folder called 'tiff' within {directory}")
-    # get all tiff files
-    files = os.listdir(tiffDir)
-    tiffFilesEdu = list(glob_re(r".*2_00_EdU_probability.tiff", files))
-    tiffFilesGene = list(glob_re(r".*1_00_17258_probability.tiff", files))
-    # get the file "prefix" without the variable ending
-    eduPrefixes = [
-        eduTiff.split("_2_00_EdU_probability.tiff")[0] for eduTiff in tiffFilesEdu
-    ]
-    genePrefixes = [
-        geneTiff.split("_1_00_17258_probability.tiff")[0] for geneTiff in tiffFilesGene
+    # index the tiff files by their "prefix" without the variable ending, one set per channel
+    prefixes = {suffix: set() for suffix in suffixes}
+    for fileName in os.listdir(tiffDir):
+        for suffix in suffixes:
+            if fileName.endswith(suffix):
+                prefixes[suffix].add(fileName[: -len(suffix)])
+    # a prefix found for every channel is a complete pair, it will be passed to the macro
+    complete = set.intersection(*prefixes.values()) if prefixes else set()
+    pathPrefixes = [os.path.join(tiffDir, prefix) for prefix in sorted(complete)]
+    # skip pairs the same macro already ran on, unless one of the tiffs or the macro changed
+    manifest = Manifest(directory, force)
+    stage = f"macro_{os.path.basename(macro)}"
+    inputs = {
+        p: [f"{p}{suffix}" for suffix in suffixes] + [macro] for p in pathPrefixes
+    }
+    pending = [p for p in pathPrefixes if not manifest.upToDate(stage, p, inputs[p])]
+    print(
+        f"{len(pathPrefixes) - len(pending)} of {len(pathPrefixes)} pairs are up to date"
+    )
+    if not pending:
+        return
+    # several Fiji processes at once, each can take a batch of prefixes so the JVM starts once per batch
+    baseCmd = [exec] + (["--headless"] if headless else []) + ["-macro", macro]
+    per_process = max(1, per_process)
+    batches = [
+        pending[i : i + per_process] for i in range(0, len(pending), per_process)
     ]
-    # build a list of complete 17258 and EdU pairs - their common prefix will be passed to the macro
-    pathPrefixes = []
-    for eduPrefix in eduPrefixes:
-        for genePrefix in genePrefixes:
-            if eduPrefix == genePrefix:
-                pathPrefix = os.path.join(tiffDir, eduPrefix)
-                pathPrefixes.append(pathPrefix)
-    for pathPrefix in pathPrefixes:
-        cmd = f"{exec} -macro {macro} {pathPrefix}"
-        print(cmd)
-        os.system(cmd)
-
-
-def glob_re(pattern, strings):
-    return filter(re.compile(pattern).match, strings)
+    tasks = [(baseCmd, batch, separator) for batch in batches]
+    runs = []
+    with ThreadPool(max(1, min(workers, len(tasks)))) as pool:
+        for batch, returncode, seconds in pool.imap_unordered(runBatch, tasks):
+            status = "done" if returncode == 0 else f"failed with code {returncode}"
+            print(f"{len(batch)} pairs {status} in {seconds:.1f}s: {', '.join(batch)}")
+            for pathPrefix in batch:
+                runs.append([pathPrefix, returncode, f"{seconds:.3f}", len(batch)])
+                if returncode == 0:
+                    outputs = [f"{pathPrefix}{s}" for s in outputSuffixes]
+                    manifest.record(stage, pathPrefix, inputs[pathPrefix], outputs)
+    # per-pair exit codes and timings (a batch's pairs share its process' code and time)
+    reportPath = os.path.join(directory, f"{stage}_runs.tsv")
+    with open(reportPath, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["prefix", "exit code", "seconds", "pairs in process"])
+        writer.writerows(sorted(runs))
+    failed = sum(1 for run in runs if run[1] != 0)
+    print(f"{failed} of {len(runs)} pairs failed, see {reportPath}")
+
+
+def runBatch(task):
+    baseCmd, batch, separator = task
+    start = time.monotonic()
+    proc = subprocess.run(baseCmd + [separator.join(batch)])
+    return batch, proc.returncode, time.monotonic() - start
 
 
 if __name__ == "__main__":
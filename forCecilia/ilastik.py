@@ -1,6 +1,9 @@
 import os
+import time
 import glob
 import subprocess
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 
 import h5py
 import click
@@ -8,6 +11,8 @@ import numpy as np
 from readlif.reader import LifFile
 import tifffile
 
+from manifest import Manifest
+
 # python ilastik.py --name EdU --ilastik "C:\Program Files\ilastik-1.3.3post3\ilastik.exe" --project C:\Users\Patrick\Desktop\Cecilia2Patrick\UTI_EPI_plusNTcData_EdU_Pixel_Classifier_06302022.ilp --directory C:\Users\Patrick\Desktop\Cecilia2Patrick --channel 2
 # python ilastik.py --name 17258 --ilastik "C:\Program Files\ilastik-1.3.3post3\ilastik.exe" --project C:\Users\Patrick\Desktop\Cecilia2Patrick\MyProject17258_Classifier_Train_NTc_06292022.ilp --directory C:\Users\Patrick\Desktop\Cecilia2Patrick --channel 1
 
@@ -48,7 +53,68 @@ import tifffile
     type=int,
     help="Specify which image channel to use with the trained ilastik project.",
 )
-def createProbabilityMaps(name, ilastik, directory, project, channel):
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Run ilastik on every h5 file, even those whose probability maps are up to date.",
+)
+@click.option(
+    "--shards",
+    type=int,
+    default=mp.cpu_count(),
+    help="Number of groups the h5 files are split into, each processed by its own ilastik run.",
+)
+@click.option(
+    "--processes",
+    type=int,
+    default=2,
+    help="Number of ilastik processes running at once.",
+)
+@click.option(
+    "--cores",
+    type=int,
+    default=mp.cpu_count(),
+    help="Total number of threads shared by the running ilastik processes (LAZYFLOW_THREADS).",
+)
+@click.option(
+    "--ram",
+    type=int,
+    default=8192,
+    help="Total RAM in MB shared by the running ilastik processes (LAZYFLOW_TOTAL_RAM_MB).",
+)
+@click.option(
+    "--retries",
+    type=int,
+    default=1,
+    help="Number of times failed shards are run again.",
+)
+@click.option(
+    "--background",
+    type=click.Choice(["keep", "strip", "cutout"]),
+    default="keep",
+    help="Keep the full probability maps, strip them down to channel 0 in fmt_tiff_probability_maps afterwards, or have ilastik export only channel 0 there in the first place (cutout).",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(["none", "zlib", "lzma"]),
+    default="none",
+    help="Compression of the stripped single-channel tiffs.",
+)
+def createProbabilityMaps(
+    name,
+    ilastik,
+    directory,
+    project,
+    channel,
+    force,
+    shards,
+    processes,
+    cores,
+    ram,
+    retries,
+    background,
+    compression,
+):
     # raise an exception if the h5 input folder does not exist
     h5Dir = os.path.join(directory, "h5")
     if not os.path.exists(h5Dir):
@@ -56,33 +122,160 @@ def createProbabilityMaps(name, ilastik, directory, project, channel):
     tiffDir = os.path.join(directory, "tiff_probability_maps")
     if not os.path.exists(tiffDir):
         os.mkdir(tiffDir)
+    fmtTiffDir = os.path.join(directory, "fmt_tiff_probability_maps")
     h5List = glob.glob(f"{h5Dir}/*_{channel}.h5")
-    h5Files = " ".join(h5List)
-    # run ilastik in headless mode and provide all h5 files as input
-    outputFormat = os.path.join(
-        tiffDir, f"{{nickname}}_{{slice_index}}_{name}_probability.tiff"
-    )
-    cmd = f'{ilastik} --headless --project={project} --output_format="tiff sequence" --output_filename_format="{outputFormat}" {h5Files}'
-    proc = subprocess.Popen(
-        cmd
-    )  # , shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    proc.wait()
+    # only h5 files that are new or changed (or all of them once the project changes) go through ilastik again
+    manifest = Manifest(directory, force)
+    stage = f"ilastik_{name}"
+    params = {"background": background}
+    h5List = [
+        p for p in h5List if not manifest.upToDate(stage, p, [p, project], params)
+    ]
+    print(f"{len(h5List)} h5 files need new probability maps")
+    if background == "cutout":
+        # ilastik exports channel 0 alone, the full multi-channel maps are never written
+        if not os.path.exists(fmtTiffDir):
+            os.mkdir(fmtTiffDir)
+        outputFormat = os.path.join(
+            fmtTiffDir,
+            f"{{nickname}}_{{slice_index}}_{name}_probability_singlechannel.tiff",
+        )
+        exportArgs = ["--cutout_subregion=[(None,None,None,0),(None,None,None,1)]"]
+    else:
+        outputFormat = os.path.join(
+            tiffDir, f"{{nickname}}_{{slice_index}}_{name}_probability.tiff"
+        )
+        exportArgs = []
+    baseCmd = [
+        ilastik,
+        "--headless",
+        f"--project={project}",
+        "--output_format=tiff sequence",
+        f"--output_filename_format={outputFormat}",
+        *exportArgs,
+    ]
+    if h5List:
+        runShards(
+            baseCmd,
+            h5List,
+            tiffDir,
+            outputFormat,
+            shards,
+            processes,
+            cores,
+            ram,
+            retries,
+            lambda h5Path, outputs: manifest.record(
+                stage, h5Path, [h5Path, project], outputs, params
+            ),
+        )
     print("done creating probability maps!")
-    # removeBackgroundProbability(directory, tiffDir, channel, name)
-    # print('done removing background from tiffs!')
+    if background == "strip":
+        removeBackgroundProbability(
+            tiffDir, fmtTiffDir, channel, name, manifest, cores, compression
+        )
+        print("done removing background from tiffs!")
 
 
-def removeBackgroundProbability(directory, tiffDir, channel, name):
-    fmtTiffDir = os.path.join(directory, "fmt_tiff_probability_maps")
+def runShards(
+    baseCmd, h5List, logDir, outputFormat, shards, processes, cores, ram, retries, done
+):
+    # split the files into shards and run a few ilastik processes at once, each with its share of threads and RAM
+    shards = shardFiles(h5List, shards)
+    processes = max(1, min(processes, len(shards)))
+    env = dict(
+        os.environ,
+        LAZYFLOW_THREADS=str(max(1, cores // processes)),
+        LAZYFLOW_TOTAL_RAM_MB=str(max(256, ram // processes)),
+    )
+    pending = list(enumerate(shards))
+    for attempt in range(retries + 1):
+        if attempt:
+            print(f"retrying {len(pending)} failed shards")
+        failed = []
+        tasks = [(baseCmd, env, logDir, i, shard) for i, shard in pending]
+        with ThreadPool(processes) as pool:
+            for i, shard, returncode, seconds, logPath in pool.imap_unordered(
+                runShard, tasks
+            ):
+                if returncode != 0:
+                    print(
+                        f"shard {i + 1}/{len(shards)} failed with code {returncode} after {seconds:.0f}s, see {logPath}"
+                    )
+                    failed.append((i, shard))
+                    continue
+                print(
+                    f"shard {i + 1}/{len(shards)} done: {len(shard)} files in {seconds:.0f}s"
+                )
+                for h5Path in shard:
+                    nickname = os.path.splitext(os.path.basename(h5Path))[0]
+                    pattern = outputFormat.replace("{nickname}", nickname)
+                    done(h5Path, glob.glob(pattern.replace("{slice_index}", "*")))
+        pending = failed
+        if not pending:
+            break
+    if pending:
+        raise Exception(
+            f"{len(pending)} of {len(shards)} ilastik shards failed: "
+            + ", ".join(str(i + 1) for i, _ in pending)
+        )
+
+
+def shardFiles(paths, shards):
+    # deal the largest files out first so every shard gets a similar number of bytes
+    paths = sorted(paths, key=os.path.getsize, reverse=True)
+    shards = max(1, min(shards, len(paths)))
+    return [paths[i::shards] for i in range(shards)]
+
+
+def runShard(task):
+    # run ilastik in headless mode on one shard, its output goes to a log file next to the probability maps
+    baseCmd, env, tiffDir, i, shard = task
+    logPath = os.path.join(tiffDir, f"ilastik_shard{i + 1}.log")
+    start = time.monotonic()
+    with open(logPath, "w") as log:
+        proc = subprocess.run(
+            baseCmd + shard, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+    return i, shard, proc.returncode, time.monotonic() - start, logPath
+
+
+def removeBackgroundProbability(
+    tiffDir, fmtTiffDir, channel, name, manifest, threads, compression
+):
     if not os.path.exists(fmtTiffDir):
-        os.mkdir(fmtTiffDir)  # get all h5 files
+        os.mkdir(fmtTiffDir)
     tiffList = glob.glob(f"{tiffDir}/*_{channel}_*_{name}_probability.tiff")
+    # only maps that are new or changed since they were last stripped
+    stage = f"strip_{name}"
+    params = {"compression": compression}
+    tasks = []
     for tiffPath in tiffList:
+        if manifest.upToDate(stage, tiffPath, [tiffPath], params):
+            continue
+        fileName = os.path.basename(tiffPath).split(".tiff")[0] + "_singlechannel.tiff"
+        tasks.append((tiffPath, os.path.join(fmtTiffDir, fileName), compression))
+    print(
+        f"{len(tasks)} of {len(tiffList)} probability maps need their background removed"
+    )
+    with ThreadPool(max(1, min(threads, len(tasks) or 1))) as pool:
+        for tiffPath, filePath in pool.imap_unordered(stripChannel, tasks):
+            manifest.record(stage, tiffPath, [tiffPath], [filePath], params)
+
+
+def stripChannel(task):
+    tiffPath, filePath, compression = task
+    try:
+        # uncompressed maps are memory-mapped so only channel 0 is copied out, never the whole array
+        tiff = tifffile.memmap(tiffPath, mode="r")
+    except ValueError:
         tiff = tifffile.imread(tiffPath)
-        tiff = tiff[:, :, 0]
-        fileName = tiffPath.split("\\")[-1].split(".tiff")[0] + "_singlechannel.tiff"
-        filePath = os.path.join(fmtTiffDir, fileName)
-        tifffile.imwrite(filePath, tiff)
+    tifffile.imwrite(
+        filePath,
+        np.ascontiguousarray(tiff[:, :, 0]),
+        compression=None if compression == "none" else compression,
+    )
+    return tiffPath, filePath
 
 
 if __name__ == "__main__":
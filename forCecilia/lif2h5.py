@@ -1,10 +1,8 @@
-import os
-import glob
+import multiprocessing as mp
 
-import h5py
 import click
-import numpy as np
-from readlif.reader import LifFile
+
+from lifExport import convertDirectory, parseChunkShape, compressionFilter, parseSeries
 
 
 @click.command()
@@ -13,39 +11,54 @@ from readlif.reader import LifFile
     required=True,
     help="""Directory containing 'lif' folder. A subdirectory 'h5' will be created to store output files.""",
 )
-def convertLifs(directory):
-    # raise an exception if the lif input folder does not exist
-    lifDir = os.path.join(directory, "lif")
-    if not os.path.exists(lifDir):
-        raise Exception(f"Expected a folder called 'lif' within {directory}")
-    # create output hdf5 folder if it does not exist
-    h5Dir = os.path.join(directory, "h5")
-    if not os.path.exists(h5Dir):
-        os.mkdir(h5Dir)
-    # get all lif files
-    lifList = glob.glob(f"{lifDir}/*.lif")
-    # iterate over each lif and split/store channels in h5fd format
-    for lifPath in lifList:
-        lif = LifFile(lifPath)
-        lifName = os.path.basename(lifPath).split(".")[0]
-        # img 1 seems to be the merged image for the file I tested, this assumption might be wrong.
-        img = lif.get_image(1)
-        nZ = img.dims.z
-        nC = img.channels
-        # iterate over each channel to save all Z layers together as an h5ad file
-        for c in range(0, nC):
-            zStack = []
-            for z in range(0, nZ):
-                zStack.append(np.array(img.get_frame(z=z, c=c)))
-            channel = np.array(zStack)
-            h5Name = f"{lifName}_{c}.h5"
-            h5Path = os.path.join(h5Dir, h5Name)
-            with h5py.File(h5Path, "w") as f:
-                grp = f.create_group("t0")
-                dset = grp.create_dataset(
-                    f"channel{c}", channel.shape, dtype="i", chunks=True
-                )
-                dset[...] = channel
+@click.option(
+    "--series",
+    type=str,
+    default="1",
+    help="Comma-separated series (image) numbers to export from every lif, or 'all'.",
+)
+@click.option(
+    "--cores",
+    type=int,
+    default=mp.cpu_count(),
+    help="Number of lif files to convert in parallel.",
+)
+@click.option(
+    "--chunk_shape",
+    type=str,
+    default="1,256,256",
+    help="HDF5 chunk shape as 'z,y,x', clipped to the stack (single-plane tiles by default suit ilastik's 2D reads, ex. 16,128,128 for 3D blocks).",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(["none", "gzip", "lz4"]),
+    default="none",
+    help="Compression filter for the HDF5 datasets (lz4 needs the hdf5plugin package).",
+)
+@click.option(
+    "--compression_level",
+    type=int,
+    default=4,
+    help="gzip compression level (0-9).",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Convert every lif, even those whose outputs are up to date.",
+)
+def convertLifs(
+    directory, series, cores, chunk_shape, compression, compression_level, force
+):
+    # split every channel of the lif files into its own h5 file (see lifExport.py to write tiffs in the same pass)
+    convertDirectory(
+        directory,
+        ["h5"],
+        parseSeries(series),
+        cores,
+        parseChunkShape(chunk_shape),
+        compressionFilter(compression, compression_level),
+        force,
+    )
 
 
 if __name__ == "__main__":
@@ -1,10 +1,8 @@
-import os
-import glob
+import multiprocessing as mp
 
 import click
-import numpy as np
-from readlif.reader import LifFile
-from tifffile import imwrite
+
+from lifExport import convertDirectory, parseSeries
 
 
 @click.command()
@@ -13,38 +11,26 @@ from tifffile import imwrite
     required=True,
     help="""Directory containing 'lif' folder. A subdirectory 'tiff' will be created to store output files.""",
 )
-def convertLifs(directory):
-    # raise an exception if the lif input folder does not exist
-    lifDir = os.path.join(directory, "lif")
-    if not os.path.exists(lifDir):
-        raise Exception(f"Expected a folder called 'lif' within {directory}")
-    # create output tiff folder if it does not exist
-    tiffDir = os.path.join(directory, "tiff")
-    if not os.path.exists(tiffDir):
-        os.mkdir(tiffDir)
-    # get all lif files
-    lifList = glob.glob(f"{lifDir}/*.lif")
-    # iterate over each lif and split/store channels in tiff format
-    for lifPath in lifList:
-        lif = LifFile(lifPath)
-        lifName = os.path.basename(lifPath).split(".")[0]
-        # img 1 seems to be the merged image for the file I tested, this assumption might be wrong.
-        img = lif.get_image(1)
-        nZ = img.dims.z
-        nC = img.channels
-        zStacks = []
-        for z in range(0, nZ):
-            zStacks.append(
-                np.array(
-                    [
-                        np.array(img.get_frame(z=z, c=0)),
-                        np.array(img.get_frame(z=z, c=1)),
-                        np.array(img.get_frame(z=z, c=2)),
-                    ]
-                )
-            )
-        tifPath = os.path.join(tiffDir, f"{lifName}.tif")
-        imwrite(tifPath, np.array(zStacks), shape=np.shape(zStacks))
+@click.option(
+    "--series",
+    type=str,
+    default="1",
+    help="Comma-separated series (image) numbers to export from every lif, or 'all'.",
+)
+@click.option(
+    "--cores",
+    type=int,
+    default=mp.cpu_count(),
+    help="Number of lif files to convert in parallel.",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Convert every lif, even those whose outputs are up to date.",
+)
+def convertLifs(directory, series, cores, force):
+    # store every series as one ZCYX BigTIFF with all of its channels (see lifExport.py to write h5 files in the same pass)
+    convertDirectory(directory, ["tiff"], parseSeries(series), cores, None, {}, force)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,321 @@
+import os
+import glob
+import itertools
+import multiprocessing as mp
+
+import h5py
+import click
+import numpy as np
+from readlif.reader import LifFile
+from tifffile import TiffWriter
+
+import omeZarr
+from manifest import Manifest
+
+try:
+    # registers the lz4 filter with h5py, only needed for --compression lz4
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# python lifExport.py --directory C:\Users\Patrick\Desktop\Cecilia2Patrick --formats tiff,h5 --series 1
+
+OUTPUT_DIRS = {"tiff": "tiff", "h5": "h5", "zarr": "zarr"}
+
+
+@click.command()
+@click.option(
+    "--directory",
+    required=True,
+    help="""Directory containing 'lif' folder. Subdirectories 'tiff', 'h5' and/or 'zarr' will be created to store output files.""",
+)
+@click.option(
+    "--formats",
+    type=str,
+    default="tiff,h5",
+    help="Comma-separated output formats, 'tiff' (one BigTIFF per series), 'h5' (one file per channel) and/or 'zarr' (one multiscale OME-Zarr per series).",
+)
+@click.option(
+    "--series",
+    type=str,
+    default="1",
+    help="Comma-separated series (image) numbers to export from every lif, or 'all' (img 1 seems to be the merged image for the file I tested, this assumption might be wrong).",
+)
+@click.option(
+    "--cores",
+    type=int,
+    default=mp.cpu_count(),
+    help="Number of lif files to convert in parallel.",
+)
+@click.option(
+    "--chunk_shape",
+    type=str,
+    default="1,256,256",
+    help="HDF5 and Zarr chunk shape as 'z,y,x', clipped to the stack (single-plane tiles by default suit ilastik's 2D reads, ex. 16,128,128 for 3D blocks).",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(["none", "gzip", "lz4"]),
+    default="none",
+    help="Compression of the HDF5 datasets and Zarr chunks (lz4 needs the hdf5plugin package for h5, numcodecs for zarr).",
+)
+@click.option(
+    "--compression_level",
+    type=int,
+    default=4,
+    help="gzip compression level (0-9).",
+)
+@click.option(
+    "--levels",
+    type=int,
+    default=None,
+    help="Resolution levels of the Zarr pyramid, each halving y and x (defaults to as many as it takes for a plane to fit in one chunk).",
+)
+@click.option(
+    "--zarr_threads",
+    type=int,
+    default=4,
+    help="Threads encoding and writing Zarr chunks for every lif file being converted.",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Convert every lif, even those whose outputs are up to date.",
+)
+def exportLifs(
+    directory,
+    formats,
+    series,
+    cores,
+    chunk_shape,
+    compression,
+    compression_level,
+    levels,
+    zarr_threads,
+    force,
+):
+    formats = [f.strip() for f in formats.split(",") if f.strip()]
+    for f in formats:
+        if f not in OUTPUT_DIRS:
+            raise click.BadParameter(
+                f"unknown format '{f}', expected tiff, h5 and/or zarr",
+                param_hint="--formats",
+            )
+    zarrOptions = None
+    if "zarr" in formats:
+        if compression == "lz4" and omeZarr.numcodecs is None:
+            raise click.UsageError("--compression lz4 needs the numcodecs package")
+        zarrOptions = {
+            "compression": compression,
+            "level": compression_level,
+            "levels": levels,
+            "threads": zarr_threads,
+        }
+    convertDirectory(
+        directory,
+        formats,
+        parseSeries(series),
+        cores,
+        parseChunkShape(chunk_shape),
+        compressionFilter(compression, compression_level) if "h5" in formats else {},
+        force,
+        zarrOptions,
+    )
+
+
+def convertDirectory(
+    directory, formats, series, cores, chunkShape, filters, force, zarrOptions=None
+):
+    # raise an exception if the lif input folder does not exist
+    lifDir = os.path.join(directory, "lif")
+    if not os.path.exists(lifDir):
+        raise Exception(f"Expected a folder called 'lif' within {directory}")
+    # create the output folders if they do not exist
+    outDirs = {f: os.path.join(directory, OUTPUT_DIRS[f]) for f in formats}
+    for outDir in outDirs.values():
+        if not os.path.exists(outDir):
+            os.mkdir(outDir)
+    # get all lif files
+    lifList = glob.glob(f"{lifDir}/*.lif")
+    # only export the formats whose outputs are missing or were made from an older version of the lif
+    manifest = Manifest(directory, force)
+    # the writer thread count does not change the output, so it is left out of the fingerprint
+    zarrLayout = zarrOptions and {
+        k: v for k, v in zarrOptions.items() if k != "threads"
+    }
+    params = {
+        "tiff": {"series": series},
+        "h5": {"series": series, "chunkShape": chunkShape, "filters": filters},
+        "zarr": {"series": series, "chunkShape": chunkShape, "zarr": zarrLayout},
+    }
+    tasks = []
+    for lifPath in lifList:
+        stale = {
+            f: outDirs[f]
+            for f in formats
+            if not manifest.upToDate(f"lif2{f}", lifPath, [lifPath], params[f])
+        }
+        if stale:
+            tasks.append((lifPath, stale, series, chunkShape, filters, zarrOptions))
+    print(f"{len(lifList) - len(tasks)} of {len(lifList)} lif files are up to date")
+    if not tasks:
+        return
+    # convert several lif files at once, each worker decodes its file once and streams it to every output
+    with mp.Pool(max(1, min(cores, len(tasks)))) as pool:
+        for lifPath, outPaths in pool.imap_unordered(exportLif, tasks):
+            for f, paths in outPaths.items():
+                manifest.record(f"lif2{f}", lifPath, [lifPath], paths, params[f])
+                for outPath in paths:
+                    print(f"wrote {outPath}")
+
+
+def exportLif(task):
+    lifPath, outDirs, series, chunkShape, filters, zarrOptions = task
+    lif = LifFile(lifPath)
+    lifName = os.path.basename(lifPath).split(".")[0]
+    series = range(lif.num_images) if series is None else series
+    outPaths = {f: [] for f in outDirs}
+    for n in series:
+        # keep the old file names when a single series is exported
+        name = lifName if len(series) == 1 else f"{lifName}_s{n}"
+        written = exportImage(
+            lif.get_image(n), name, outDirs, chunkShape, filters, zarrOptions
+        )
+        for f, paths in written.items():
+            outPaths[f] += paths
+    return lifPath, outPaths
+
+
+def exportImage(img, name, outDirs, chunkShape, filters, zarrOptions=None):
+    nZ = img.dims.z
+    nC = img.channels
+    h5Writers = []
+    if "h5" in outDirs:
+        h5Writers = [
+            ChannelWriter(
+                os.path.join(outDirs["h5"], f"{name}_{c}.h5"), c, chunkShape, filters
+            )
+            for c in range(nC)
+        ]
+    zarrWriter = None
+    if "zarr" in outDirs:
+        zarrWriter = omeZarr.ZarrWriter(
+            os.path.join(outDirs["zarr"], f"{name}.ome.zarr"),
+            name,
+            nC,
+            nZ,
+            chunkShape,
+            pixelSize(img),
+            **(zarrOptions or {}),
+        )
+    frames = decodeFrames(img, nZ, nC, h5Writers, zarrWriter)
+    # the first plane fixes the shape and the native dtype of every output
+    first = next(frames)
+    frames = itertools.chain([first], frames)
+    outPaths = {"h5": [w.path for w in h5Writers]} if h5Writers else {}
+    if zarrWriter is not None:
+        outPaths["zarr"] = [zarrWriter.path]
+    try:
+        if "tiff" in outDirs:
+            tifPath = os.path.join(outDirs["tiff"], f"{name}.tif")
+            # planes go out page by page in Z, C order as they are decoded
+            with TiffWriter(tifPath, bigtiff=True) as tif:
+                tif.write(
+                    frames,
+                    shape=(nZ, nC, *first.shape),
+                    dtype=first.dtype,
+                    photometric="minisblack",
+                    metadata={"axes": "ZCYX"},
+                )
+            outPaths["tiff"] = [tifPath]
+        else:
+            for _ in frames:
+                pass
+    finally:
+        for w in h5Writers:
+            w.close()
+        if zarrWriter is not None:
+            zarrWriter.close()
+    return outPaths
+
+
+def decodeFrames(img, nZ, nC, writers, zarrWriter=None):
+    # every frame is decoded once, handed to the per-channel and zarr writers and yielded to the TIFF writer
+    for z in range(nZ):
+        for c in range(nC):
+            plane = np.asarray(img.get_frame(z=z, c=c))
+            if writers:
+                writers[c].write(z, nZ, plane)
+            if zarrWriter is not None:
+                zarrWriter.write(z, c, plane)
+            yield plane
+
+
+def pixelSize(img):
+    # (z, y, x) voxel size in micrometers, readlif's scale is in pixels per micrometer (x, y, z, t)
+    scale = getattr(img, "scale", None)
+    if not scale or not all(scale[:3]):
+        return None
+    return (1 / scale[2], 1 / scale[1], 1 / scale[0])
+
+
+class ChannelWriter:
+    # one channel of one series as t0/channel{c} in its own HDF5 file, written plane by plane
+    def __init__(self, path, c, chunkShape, filters):
+        self.path = path
+        self.c = c
+        self.chunkShape = chunkShape
+        self.filters = filters
+        self.file = None
+
+    def write(self, z, nZ, plane):
+        if self.file is None:
+            shape = (nZ, *plane.shape)
+            chunks = tuple(min(n, size) for n, size in zip(self.chunkShape, shape))
+            # hold one z-row of chunks in h5py's chunk cache so each chunk is compressed once, not once per plane
+            cacheBytes = max(2**20, chunks[0] * plane.nbytes * 2)
+            self.file = h5py.File(
+                self.path, "w", rdcc_nbytes=cacheBytes, rdcc_nslots=10007
+            )
+            grp = self.file.create_group("t0")
+            self.dset = grp.create_dataset(
+                f"channel{self.c}",
+                shape,
+                dtype=plane.dtype,
+                chunks=chunks,
+                **self.filters,
+            )
+        self.dset[z] = plane
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def parseSeries(series):
+    return None if series == "all" else [int(s) for s in series.split(",")]
+
+
+def parseChunkShape(chunkShape):
+    chunkShape = tuple(int(x) for x in chunkShape.split(","))
+    if len(chunkShape) != 3 or min(chunkShape) < 1:
+        raise click.BadParameter(
+            "expected three positive integers 'z,y,x'", param_hint="--chunk_shape"
+        )
+    return chunkShape
+
+
+def compressionFilter(compression, level):
+    # keyword arguments for h5py's create_dataset
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": level}
+    if compression == "lz4":
+        if hdf5plugin is None:
+            raise click.UsageError("--compression lz4 needs the hdf5plugin package")
+        return dict(hdf5plugin.LZ4())
+    return {}
+
+
+if __name__ == "__main__":
+    exportLifs()
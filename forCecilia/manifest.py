@@ -0,0 +1,110 @@
+import os
+import json
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+MANIFEST = "manifest.json"
+
+
+class Manifest:
+    # per stage and input path, the size and mtime of every input a step read and the outputs it wrote,
+    # kept in <directory>/manifest.json so each stage can skip work that is already up to date
+    def __init__(self, directory, force=False):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST)
+        self.force = force
+        self.lock = threading.Lock()
+        self.stages = self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def upToDate(self, stage, key, inputs, params=None):
+        # True if the step ran with these exact inputs and parameters and all of its outputs still exist
+        if self.force:
+            return False
+        entry = self.stages.get(stage, {}).get(self.relative(key))
+        if entry is None or entry["params"] != normalize(params):
+            return False
+        # a missing input is never up to date, even if it was already missing when the step ran
+        current = self.fingerprints(inputs)
+        if current is None or entry["inputs"] != current:
+            return False
+        return all(
+            os.path.exists(os.path.join(self.directory, p)) for p in entry["outputs"]
+        )
+
+    def record(self, stage, key, inputs, outputs, params=None):
+        entry = {
+            "inputs": self.fingerprints(inputs),
+            "outputs": [self.relative(p) for p in outputs],
+            "params": normalize(params),
+        }
+        # other stages or runs may have recorded steps in the same directory since it was read,
+        # merge into the current file instead of overwriting their entries
+        with self.lock, lockedFile(f"{self.path}.lock"):
+            self.stages = self.load()
+            self.stages.setdefault(stage, {})[self.relative(key)] = entry
+            self.save()
+
+    def fingerprints(self, inputs):
+        found = {}
+        for p in inputs:
+            if not os.path.exists(p):
+                return None
+            stat = os.stat(p)
+            found[self.relative(p)] = [stat.st_size, stat.st_mtime_ns]
+        return found
+
+    def relative(self, path):
+        try:
+            return os.path.relpath(path, self.directory)
+        except ValueError:
+            # on another Windows drive than the directory
+            return os.path.abspath(path)
+
+    def save(self):
+        tmpPath = f"{self.path}.tmp"
+        with open(tmpPath, "w") as f:
+            json.dump(self.stages, f, indent=1)
+        os.replace(tmpPath, self.path)
+
+
+@contextlib.contextmanager
+def lockedFile(path):
+    # an exclusive lock shared by every process using the same directory
+    with open(path, "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after about 10 seconds
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def normalize(params):
+    # parameters as they read back from json, so tuples and lists compare equal
+    return json.loads(json.dumps(params))
@@ -0,0 +1,228 @@
+import os
+import gzip
+import json
+import shutil
+import functools
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+try:
+    # only needed for lz4 compressed chunks
+    import numcodecs
+except ImportError:
+    numcodecs = None
+
+# encoded chunks queued per writer before write() waits for the oldest
+WRITES_IN_FLIGHT = 64
+
+
+class ZarrWriter:
+    # one series as a multiscale OME-Zarr (NGFF 0.4) image with axes c, z, y, x, in the zarr v2 layout.
+    # Planes are handed over one at a time, every level halves y and x of the one above with a 2x2 block
+    # mean, and a level's chunks are encoded and written on a thread pool as soon as their z-block is full
+    def __init__(
+        self,
+        path,
+        name,
+        nC,
+        nZ,
+        chunkShape,
+        pixelSize=None,
+        compression="none",
+        level=4,
+        levels=None,
+        threads=4,
+    ):
+        self.path = path
+        # written next to the final path and moved there by close(), so a crash never leaves half an image
+        self.tmpPath = f"{path}.tmp"
+        self.name = name
+        self.nC = nC
+        self.nZ = nZ
+        self.chunkShape = chunkShape
+        self.pixelSize = pixelSize
+        self.compressor, self.encode = zarrCodec(compression, level)
+        self.levels = levels
+        self.threads = threads
+        self.shapes = None
+        self.planes = 0
+
+    def write(self, z, c, plane):
+        if self.shapes is None:
+            self.open(plane)
+        for level in range(len(self.shapes)):
+            if level > 0:
+                plane = downsample(plane)
+            chunkZ = self.chunks[level][0]
+            block = self.blocks.get((level, c))
+            if block is None:
+                depth = min(chunkZ, self.nZ - z)
+                block = self.blocks[level, c] = np.empty(
+                    (depth, *plane.shape), plane.dtype
+                )
+            block[z % chunkZ] = plane
+            if z % chunkZ == len(block) - 1:
+                # the z-block is complete, its chunks no longer change
+                del self.blocks[level, c]
+                self.writeBlock(level, c, z // chunkZ, block)
+        self.planes += 1
+
+    def open(self, plane):
+        y, x = plane.shape
+        self.dtype = plane.dtype
+        self.shapes = [(y, x)]
+        if self.levels:
+            while len(self.shapes) < self.levels:
+                y, x = (y + 1) // 2, (x + 1) // 2
+                self.shapes.append((y, x))
+        else:
+            # halve until a plane fits into one chunk
+            while y > self.chunkShape[1] or x > self.chunkShape[2]:
+                y, x = (y + 1) // 2, (x + 1) // 2
+                self.shapes.append((y, x))
+        self.chunks = [
+            tuple(min(n, size) for n, size in zip(self.chunkShape, (self.nZ, y, x)))
+            for y, x in self.shapes
+        ]
+        self.blocks = {}
+        self.pending = deque()
+        self.pool = ThreadPool(self.threads)
+        if os.path.exists(self.tmpPath):
+            shutil.rmtree(self.tmpPath)
+        os.makedirs(self.tmpPath)
+        writeJson(os.path.join(self.tmpPath, ".zgroup"), {"zarr_format": 2})
+        writeJson(os.path.join(self.tmpPath, ".zattrs"), self.multiscales())
+        for level, (y, x) in enumerate(self.shapes):
+            os.makedirs(os.path.join(self.tmpPath, str(level)))
+            writeJson(
+                os.path.join(self.tmpPath, str(level), ".zarray"),
+                {
+                    "zarr_format": 2,
+                    "shape": [self.nC, self.nZ, y, x],
+                    "chunks": [1, *self.chunks[level]],
+                    "dtype": self.dtype.str,
+                    "compressor": self.compressor,
+                    "fill_value": 0,
+                    "order": "C",
+                    "filters": None,
+                    "dimension_separator": "/",
+                },
+            )
+
+    def multiscales(self):
+        sizeZ, sizeY, sizeX = self.pixelSize or (1.0, 1.0, 1.0)
+        unit = {"unit": "micrometer"} if self.pixelSize else {}
+        return {
+            "multiscales": [
+                {
+                    "version": "0.4",
+                    "name": self.name,
+                    "axes": [
+                        {"name": "c", "type": "channel"},
+                        {"name": "z", "type": "space", **unit},
+                        {"name": "y", "type": "space", **unit},
+                        {"name": "x", "type": "space", **unit},
+                    ],
+                    "datasets": [
+                        {
+                            "path": str(level),
+                            "coordinateTransformations": [
+                                {
+                                    "type": "scale",
+                                    "scale": [
+                                        1.0,
+                                        sizeZ,
+                                        sizeY * 2**level,
+                                        sizeX * 2**level,
+                                    ],
+                                }
+                            ],
+                        }
+                        for level in range(len(self.shapes))
+                    ],
+                    "type": "mean",
+                    "metadata": {"method": "2x2 block mean in y and x"},
+                }
+            ]
+        }
+
+    def writeBlock(self, level, c, zBlock, block):
+        _, chunkY, chunkX = self.chunks[level]
+        y, x = self.shapes[level]
+        for yBlock in range((y + chunkY - 1) // chunkY):
+            for xBlock in range((x + chunkX - 1) // chunkX):
+                tile = block[
+                    :,
+                    yBlock * chunkY : (yBlock + 1) * chunkY,
+                    xBlock * chunkX : (xBlock + 1) * chunkX,
+                ]
+                key = f"{level}/{c}/{zBlock}/{yBlock}/{xBlock}"
+                self.pending.append(
+                    self.pool.apply_async(
+                        self.writeChunk, (key, tile, self.chunks[level])
+                    )
+                )
+                while len(self.pending) > WRITES_IN_FLIGHT:
+                    self.pending.popleft().get()
+
+    def writeChunk(self, key, tile, chunkShape):
+        # zarr v2 stores edge chunks at full size, padded with the fill value
+        if tile.shape != chunkShape:
+            padded = np.zeros(chunkShape, tile.dtype)
+            padded[tuple(slice(0, n) for n in tile.shape)] = tile
+            tile = padded
+        path = os.path.join(self.tmpPath, *key.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(self.encode(np.ascontiguousarray(tile).tobytes()))
+
+    def close(self):
+        if self.shapes is None:
+            return
+        self.shapes = None
+        complete = False
+        try:
+            while self.pending:
+                self.pending.popleft().get()
+            complete = self.planes == self.nC * self.nZ
+        finally:
+            self.pool.close()
+            self.pool.join()
+            if not complete:
+                # the export failed part way through
+                shutil.rmtree(self.tmpPath, ignore_errors=True)
+        if not complete:
+            return
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmpPath, self.path)
+
+
+def downsample(plane):
+    # mean of every 2x2 block, an odd last row or column is averaged with itself
+    y, x = plane.shape
+    if y % 2 or x % 2:
+        plane = np.pad(plane, ((0, y % 2), (0, x % 2)), mode="edge")
+    blocks = plane.reshape(plane.shape[0] // 2, 2, plane.shape[1] // 2, 2)
+    mean = blocks.mean(axis=(1, 3), dtype=np.float64)
+    if np.issubdtype(plane.dtype, np.integer):
+        mean = np.rint(mean)
+    return mean.astype(plane.dtype)
+
+
+def zarrCodec(compression, level):
+    # the .zarray compressor entry and the function that encodes a chunk's bytes with it
+    if compression == "gzip":
+        encode = functools.partial(gzip.compress, compresslevel=level, mtime=0)
+        return {"id": "gzip", "level": level}, encode
+    if compression == "lz4":
+        codec = numcodecs.LZ4()
+        return codec.get_config(), codec.encode
+    return None, lambda data: data
+
+
+def writeJson(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=1)
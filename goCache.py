@@ -0,0 +1,142 @@
+import os
+import csv
+import time
+import sqlite3
+
+import click
+
+DEFAULT_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "smedGO", "planmine.sqlite"
+)
+
+# python goCache.py --dump planmine_go.tsv --release 3.0 (dump columns: contig, GO identifier, name, description)
+
+
+class GOCache:
+    # GO terms per (contig, PlanMine release), contigs without terms are remembered too
+    def __init__(self, path=DEFAULT_CACHE):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS contigs ("
+            "contig TEXT NOT NULL, release TEXT NOT NULL, fetched REAL NOT NULL, "
+            "PRIMARY KEY (contig, release))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS terms ("
+            "contig TEXT NOT NULL, release TEXT NOT NULL, identifier TEXT, name TEXT, description TEXT)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS termsContig ON terms (contig, release)"
+        )
+
+    def get(self, contigs, release, ttl=None):
+        # cached terms of every contig looked up within the last ttl seconds (any age if ttl is None)
+        oldest = 0 if ttl is None else time.time() - ttl
+        found = {}
+        for contig in contigs:
+            if contig in found:
+                continue
+            fetched = self.db.execute(
+                "SELECT fetched FROM contigs WHERE contig = ? AND release = ?",
+                (contig, release),
+            ).fetchone()
+            if fetched is None or fetched[0] < oldest:
+                continue
+            found[contig] = [
+                {
+                    "contig": contig,
+                    "identifier": identifier,
+                    "name": name,
+                    "description": description,
+                }
+                for identifier, name, description in self.db.execute(
+                    "SELECT identifier, name, description FROM terms WHERE contig = ? AND release = ?",
+                    (contig, release),
+                )
+            ]
+        return found
+
+    def put(self, found, release):
+        now = time.time()
+        with self.db:
+            for contig, terms in found.items():
+                self.db.execute(
+                    "DELETE FROM terms WHERE contig = ? AND release = ?",
+                    (contig, release),
+                )
+                self.db.execute(
+                    "INSERT OR REPLACE INTO contigs VALUES (?, ?, ?)",
+                    (contig, release, now),
+                )
+                self.db.executemany(
+                    "INSERT INTO terms VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (contig, release, t["identifier"], t["name"], t["description"])
+                        for t in terms
+                    ],
+                )
+
+    def latestRelease(self):
+        row = self.db.execute(
+            "SELECT release FROM contigs ORDER BY fetched DESC LIMIT 1"
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def close(self):
+        self.db.close()
+
+
+@click.command()
+@click.option(
+    "-d",
+    "--dump",
+    required=True,
+    type=str,
+    help="Specify the tab-separated PlanMine GO dump to import (contig, GO identifier, name, description).",
+)
+@click.option(
+    "-r",
+    "--release",
+    required=True,
+    type=str,
+    help="Specify the PlanMine release the dump was exported from.",
+)
+@click.option(
+    "--cache",
+    type=str,
+    default=DEFAULT_CACHE,
+    help="Specify the local GO cache to import into.",
+)
+def importDump(dump, release, cache):
+    found = {}
+    with open(dump, "r") as f:
+        for row in csv.reader(f, delimiter="\t"):
+            # skip comments, blank lines and a header row
+            if (
+                not row
+                or row[0].startswith("#")
+                or row[0] in ["primaryIdentifier", "contig"]
+            ):
+                continue
+            row += [""] * (4 - len(row))
+            contig, identifier, name, description = row[:4]
+            found.setdefault(contig, [])
+            if identifier or name or description:
+                found[contig].append(
+                    {
+                        "contig": contig,
+                        "identifier": identifier,
+                        "name": name,
+                        "description": description,
+                    }
+                )
+    goCache = GOCache(cache)
+    goCache.put(found, release)
+    goCache.close()
+    print(f"imported GO terms for {len(found)} contigs into {cache}")
+
+
+if __name__ == "__main__":
+    importDump()
@@ -0,0 +1,121 @@
+import os
+import json
+import shutil
+import socket
+import hashlib
+import tempfile
+import subprocess
+
+PRESSED_SUFFIXES = [".h3m", ".h3i", ".h3f", ".h3p"]
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "annotateTranscriptome")
+
+
+def pressModel(model, hmmerbin, cacheDir=None, press=None):
+    # press next to the model when possible, otherwise into a cache directory,
+    # with hmmer's hmmpress unless another press function is given
+    model = os.path.abspath(model)
+    if cacheDir is None and os.access(os.path.dirname(model), os.W_OK):
+        pressed = model
+    else:
+        cacheDir = cacheDir or DEFAULT_CACHE
+        os.makedirs(cacheDir, exist_ok=True)
+        # models with the same file name in different directories must not share a pressed copy
+        pathHash = hashlib.sha256(model.encode()).hexdigest()[:16]
+        pressed = os.path.join(cacheDir, f"{pathHash}_{os.path.basename(model)}")
+        if os.path.islink(pressed) and os.readlink(pressed) != model:
+            os.remove(pressed)
+        if not os.path.lexists(pressed):
+            try:
+                os.symlink(model, pressed)
+            except FileExistsError:
+                # created by a concurrent run
+                pass
+    stampPath = f"{pressed}.press.json"
+    stamp = readStamp(stampPath)
+    stat = os.stat(model)
+    havePressed = all(os.path.exists(pressed + s) for s in PRESSED_SUFFIXES)
+    if stamp and havePressed and stamp["size"] == stat.st_size:
+        if stamp["mtime"] == stat.st_mtime:
+            return pressed, stamp
+        # the model was touched, only re-press if its content actually changed
+        if stamp["sha256"] == fileHash(model):
+            stamp["mtime"] = stat.st_mtime
+            writeStamp(stampPath, stamp)
+            return pressed, stamp
+    if not (stamp is None and havePressed and pressedIsNewer(pressed, stat)):
+        pressAtomically(pressed, hmmerbin, press)
+    stamp = {
+        "model": model,
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "sha256": fileHash(model),
+        "descriptions": modelDescriptions(model),
+    }
+    writeStamp(stampPath, stamp)
+    return pressed, stamp
+
+
+def pressAtomically(pressed, hmmerbin, press):
+    # press through a private link and move the files into place, so runs sharing the model (job array
+    # shards) never scan half-written files or delete each other's
+    tmpDir = tempfile.mkdtemp(prefix=".press", dir=os.path.dirname(pressed))
+    try:
+        tmpPrefix = os.path.join(tmpDir, os.path.basename(pressed))
+        os.symlink(os.path.realpath(pressed), tmpPrefix)
+        if press is None:
+            subprocess.run(
+                [os.path.join(hmmerbin, "hmmpress"), "-f", tmpPrefix],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+        else:
+            press(tmpPrefix)
+        for suffix in PRESSED_SUFFIXES:
+            os.replace(tmpPrefix + suffix, pressed + suffix)
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+def pressedIsNewer(pressed, stat):
+    # pressed files built by hand before the first run are reused as long as they are newer than the model
+    return all(os.stat(pressed + s).st_mtime >= stat.st_mtime for s in PRESSED_SUFFIXES)
+
+
+def modelDescriptions(model):
+    # map every profile NAME to its DESC line, hmmsearch tables only carry the sequence description
+    # (profiles without one get hmmscan's "-")
+    descriptions = {}
+    name = None
+    with open(model, "r") as f:
+        for line in f:
+            if line.startswith("NAME "):
+                name = line[5:].strip()
+                descriptions[name] = "-"
+            elif line.startswith("DESC ") and name is not None:
+                descriptions[name] = line[5:].strip()
+            elif line.startswith("HMM "):
+                name = None
+    return descriptions
+
+
+def fileHash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def readStamp(stampPath):
+    if not os.path.exists(stampPath):
+        return None
+    with open(stampPath, "r") as f:
+        return json.load(f)
+
+
+def writeStamp(stampPath, stamp):
+    # one temporary file per process, concurrent runs may write the same stamp
+    tmpPath = f"{stampPath}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmpPath, "w") as f:
+        json.dump(stamp, f)
+    os.replace(tmpPath, stampPath)
@@ -0,0 +1,108 @@
+import io
+
+# column layouts of hmmer's --tblout and --domtblout tables, the free-text description is always last
+TBLOUT_FIELDS = [
+    ("target", str),
+    ("targetAccession", str),
+    ("query", str),
+    ("queryAccession", str),
+    ("fullE", float),
+    ("fullScore", float),
+    ("fullBias", float),
+    ("bestDomainE", float),
+    ("bestDomainScore", float),
+    ("bestDomainBias", float),
+    ("exp", float),
+    ("reg", int),
+    ("clu", int),
+    ("ov", int),
+    ("env", int),
+    ("dom", int),
+    ("rep", int),
+    ("inc", int),
+    ("description", str),
+]
+DOMTBLOUT_FIELDS = [
+    ("target", str),
+    ("targetAccession", str),
+    ("targetLength", int),
+    ("query", str),
+    ("queryAccession", str),
+    ("queryLength", int),
+    ("fullE", float),
+    ("fullScore", float),
+    ("fullBias", float),
+    ("domain", int),
+    ("domains", int),
+    ("conditionalE", float),
+    ("independentE", float),
+    ("domainScore", float),
+    ("domainBias", float),
+    ("hmmFrom", int),
+    ("hmmTo", int),
+    ("aliFrom", int),
+    ("aliTo", int),
+    ("envFrom", int),
+    ("envTo", int),
+    ("accuracy", float),
+    ("description", str),
+]
+
+
+class TableRow:
+    __slots__ = ()
+    FIELDS = []
+
+    def __init__(self, fields):
+        for (name, cast), value in zip(self.FIELDS, fields):
+            setattr(self, name, cast(value))
+        if len(fields) < len(self.FIELDS):
+            self.description = ""
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.query} -> {self.target}, E={self.fullE:g})"
+
+
+class TableHit(TableRow):
+    # one line of --tblout: a query/target pair with full-sequence and best-domain scores
+    __slots__ = [name for name, _ in TBLOUT_FIELDS]
+    FIELDS = TBLOUT_FIELDS
+
+
+class DomainHit(TableRow):
+    # one line of --domtblout: a single domain of a query/target pair with its coordinates
+    __slots__ = [name for name, _ in DOMTBLOUT_FIELDS]
+    FIELDS = DOMTBLOUT_FIELDS
+
+
+def parseTblout(source, maxE=None, minScore=None):
+    return parseTable(source, TableHit, maxE, minScore)
+
+
+def parseDomtblout(source, maxE=None, minScore=None):
+    return parseTable(source, DomainHit, maxE, minScore)
+
+
+def parseTable(source, hitType, maxE=None, minScore=None):
+    # stream hits from a table path, an open file or any iterable of (byte) lines, filtering on full-sequence scores
+    if isinstance(source, str):
+        with open(source, "r") as f:
+            yield from parseTable(f, hitType, maxE, minScore)
+        return
+    if isinstance(source, io.BufferedIOBase):
+        source = io.TextIOWrapper(source)
+    nSplit = len(hitType.FIELDS) - 1
+    for line in source:
+        if isinstance(line, bytes):
+            line = line.decode()
+        if line.startswith("#") or not line.strip():
+            continue
+        fields = line.split(maxsplit=nSplit)
+        if len(fields) > nSplit:
+            fields[-1] = fields[-1].strip()
+        hit = hitType(fields)
+        if maxE is not None and hit.fullE > maxE:
+            continue
+        if minScore is not None and hit.fullScore < minScore:
+            continue
+        yield hit
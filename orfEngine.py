@@ -0,0 +1,107 @@
+import numpy as np
+from Bio.Seq import Seq
+
+# bases are coded T=0, C=1, A=2, G=3 so a codon's index into the standard code is 16 * b1 + 4 * b2 + b3,
+# anything else (N, IUPAC codes, the separator between sequences) is coded 4 and never forms a codon
+CODES = np.full(256, 4, dtype=np.uint8)
+for code, bases in enumerate(["Tt", "Cc", "Aa", "Gg"]):
+    for base in bases:
+        CODES[ord(base)] = code
+AMINO = np.frombuffer(
+    b"FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG", dtype=np.uint8
+)
+START = 35  # ATG
+STOPS = [10, 11, 14]  # TAA, TAG, TGA
+NO_CODON = 64
+COMPLEMENT = str.maketrans(
+    "ACGTURYKMBVDHSWNacgturykmbvdhswn", "TGCAAYRMKVBHDSWNtgcaayrmkvbhdswn"
+)
+
+
+def findORFs(sequences, minLength=75, top=1):
+    # the `top` longest ORFs of every sequence, ranked and cut exactly like orffinder.getORFs
+    sequences = [str(s) for s in sequences]
+    lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+    reverses = [s[::-1].translate(COMPLEMENT) for s in sequences]
+    # orffinder cuts the last base off forward trailing ORFs but not off reverse ones
+    candidates = [
+        senseORFs(sequences, lengths, minLength, trailingTrim=1),
+        senseORFs(reverses, lengths, minLength, trailingTrim=0),
+    ]
+    seq, start, end, length, trailing = [
+        np.concatenate([c[i] for c in candidates]) for i in range(5)
+    ]
+    sense = np.repeat([0, 1], [len(c[0]) for c in candidates])
+    # longest first, ties go to the start orffinder meets first (lowest position, forward strand first)
+    order = np.lexsort((sense, start, -length, seq))
+    orfs = [[] for _ in sequences]
+    for i in order:
+        found = orfs[seq[i]]
+        if len(found) == top:
+            continue
+        strand = sequences if sense[i] == 0 else reverses
+        nucleotide = strand[seq[i]][start[i] : end[i]].upper()
+        found.append(
+            {
+                "sense": "+-"[sense[i]],
+                "frame": int(start[i] % 3) + 1,
+                "start": int(start[i]) + 1,
+                "length": int(length[i]),
+                "trailing": bool(trailing[i]),
+                "nucleotide": nucleotide,
+                "protein": translate(nucleotide),
+            }
+        )
+    return orfs
+
+
+def translateORFs(sequences, minLength=75, top=1):
+    return [
+        [Seq(orf["protein"]) for orf in orfs]
+        for orfs in findORFs(sequences, minLength, top)
+    ]
+
+
+def senseORFs(sequences, lengths, minLength, trailingTrim):
+    # one sense of all sequences at once: join them with a separator so no codon spans two sequences
+    codes = CODES[np.frombuffer("N".join(sequences).encode(), dtype=np.uint8)].astype(
+        np.int16
+    )
+    empty = np.zeros(0, dtype=np.int64)
+    if len(codes) < 3:
+        return empty, empty, empty, empty, empty.astype(bool)
+    codons = codes[:-2] * 16 + codes[1:-1] * 4 + codes[2:]
+    codons[(codes[:-2] == 4) | (codes[1:-1] == 4) | (codes[2:] == 4)] = NO_CODON
+    offsets = np.concatenate([[0], np.cumsum(lengths + 1)[:-1]])
+    seqOf = np.repeat(np.arange(len(sequences)), lengths + 1)[: len(codons)]
+    local = np.arange(len(codons)) - offsets[seqOf]
+    # sort codons by (sequence, frame, position) so a start's next in-frame stop is one searchsorted away
+    span = len(codons) + 1
+    keys = (seqOf * 3 + local % 3) * span + local
+    startKeys = np.sort(keys[codons == START])
+    stopKeys = np.sort(keys[np.isin(codons, STOPS)])
+    nextStop = np.searchsorted(stopKeys, startKeys)
+    hasStop = nextStop < len(stopKeys)
+    hasStop[hasStop] = stopKeys[nextStop[hasStop]] // span == startKeys[hasStop] // span
+    # only the first start before a stop claims it, later (nested) starts are dropped,
+    # but every start without a downstream stop runs off the end as a trailing ORF
+    claimed = hasStop.copy()
+    withStop = np.flatnonzero(hasStop)
+    claimed[withStop[1:]] &= nextStop[withStop[1:]] != nextStop[withStop[:-1]]
+    seq = startKeys // span // 3
+    start = startKeys % span
+    stop = np.zeros(len(startKeys), dtype=np.int64)
+    stop[hasStop] = stopKeys[nextStop[hasStop]] % span
+    length = np.where(hasStop, stop - start + 3, lengths[seq] - start - 1)
+    end = np.where(hasStop, stop + 3, lengths[seq] - trailingTrim)
+    keep = (claimed | ~hasStop) & (length >= minLength)
+    return seq[keep], start[keep], end[keep], length[keep], ~hasStop[keep]
+
+
+def translate(nucleotide):
+    codes = CODES[np.frombuffer(nucleotide.encode(), dtype=np.uint8)].astype(np.int16)
+    n = len(codes) // 3 * 3
+    if (codes[:n] == 4).any():
+        # ambiguous bases need Biopython's ambiguity-aware translation
+        return str(Seq(nucleotide[:n]).translate())
+    return AMINO[codes[0:n:3] * 16 + codes[1:n:3] * 4 + codes[2:n:3]].tobytes().decode()
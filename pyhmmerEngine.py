@@ -0,0 +1,69 @@
+import os
+
+from hmmerDatabase import PRESSED_SUFFIXES
+
+try:
+    # optional, only needed for --engine pyhmmer
+    import pyhmmer
+    from pyhmmer.easel import Alphabet, SequenceFile
+    from pyhmmer.plan7 import HMMFile, OptimizedProfileBlock
+except ImportError:
+    pyhmmer = None
+
+
+class ProfileDatabase:
+    # the pressed profiles, read and optimized once per run and scanned from several threads at once
+    # (pyhmmer locks a profile while reconfiguring it for a sequence's length)
+    def __init__(self, pressed):
+        self.alphabet = Alphabet.amino()
+        with HMMFile(pressed) as f:
+            self.profiles = OptimizedProfileBlock(self.alphabet, f.optimized_profiles())
+
+    def scan(self, fastaPath, cpus):
+        # like hmmscan --domtblout: one hit per reported domain, E-values count every profile as a comparison
+        with SequenceFile(fastaPath, digital=True, alphabet=self.alphabet) as f:
+            sequences = f.read_block()
+        for topHits in pyhmmer.hmmer.hmmscan(sequences, self.profiles, cpus=cpus):
+            query = text(topHits.query.name)
+            for hit in topHits.reported:
+                for domain in hit.domains.reported:
+                    yield ScanHit(query, hit, domain)
+
+
+class ScanHit:
+    # the fields of a --domtblout row that collectHits reads
+    __slots__ = [
+        "target",
+        "query",
+        "description",
+        "fullE",
+        "fullScore",
+        "fullBias",
+        "envFrom",
+        "envTo",
+    ]
+
+    def __init__(self, query, hit, domain):
+        self.target = text(hit.name)
+        self.query = query
+        # hmmer writes "-" for profiles without a DESC line
+        self.description = text(hit.description) or "-"
+        self.fullE = hit.evalue
+        self.fullScore = hit.score
+        self.fullBias = hit.bias
+        self.envFrom = domain.env_from
+        self.envTo = domain.env_to
+
+
+def press(pressed):
+    # hmmpress -f without the hmmer binaries, pyhmmer refuses to overwrite an existing index
+    for suffix in PRESSED_SUFFIXES:
+        if os.path.exists(pressed + suffix):
+            os.remove(pressed + suffix)
+    with HMMFile(pressed) as f:
+        pyhmmer.hmmer.hmmpress(f, pressed)
+
+
+def text(value):
+    # names are bytes in pyhmmer before 0.11
+    return value.decode() if isinstance(value, bytes) else value
@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+MISSING = object()
+# mount types SQLite's WAL mode cannot be shared on, its -shm index needs every process on one host
+NETWORK_FILESYSTEMS = {
+    "nfs",
+    "nfs4",
+    "cifs",
+    "smb3",
+    "smbfs",
+    "afs",
+    "lustre",
+    "gpfs",
+    "beegfs",
+    "ceph",
+    "glusterfs",
+    "fuse.sshfs",
+}
+
+
+class ResultCache:
+    # domain hits keyed by the translated ORF's hash and the identity (sha256) of the HMM model file
+    def __init__(self, path, modelHash):
+        self.path = path
+        self.modelHash = modelHash
+        self.db = sqlite3.connect(path, timeout=120, isolation_level=None)
+        # WAL lets every pool worker read and write the same file concurrently
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS hits ("
+            "protein TEXT NOT NULL, model TEXT NOT NULL, result TEXT, used REAL NOT NULL, "
+            "PRIMARY KEY (protein, model))"
+        )
+
+    def get(self, protein):
+        key = proteinHash(protein)
+        row = self.db.execute(
+            "SELECT result FROM hits WHERE protein = ? AND model = ?",
+            (key, self.modelHash),
+        ).fetchone()
+        if row is None:
+            return MISSING
+        self.db.execute(
+            "UPDATE hits SET used = ? WHERE protein = ? AND model = ?",
+            (time.time(), key, self.modelHash),
+        )
+        return json.loads(row[0])
+
+    def put(self, protein, result):
+        self.db.execute(
+            "INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?)",
+            (proteinHash(protein), self.modelHash, json.dumps(result), time.time()),
+        )
+
+    def evict(self, maxBytes):
+        # drop the least recently used results until the stored results fit in maxBytes
+        total = self.db.execute(
+            "SELECT COALESCE(SUM(LENGTH(protein) + LENGTH(model) + LENGTH(result)), 0) FROM hits"
+        ).fetchone()[0]
+        if total <= maxBytes and os.path.getsize(self.path) <= maxBytes:
+            return 0
+        evicted = 0
+        rows = self.db.execute(
+            "SELECT rowid, LENGTH(protein) + LENGTH(model) + LENGTH(result) FROM hits ORDER BY used"
+        ).fetchall()
+        self.db.execute("BEGIN")
+        for rowid, size in rows:
+            if total <= maxBytes * 0.9:
+                break
+            self.db.execute("DELETE FROM hits WHERE rowid = ?", (rowid,))
+            total -= size
+            evicted += 1
+        self.db.execute("COMMIT")
+        self.db.execute("VACUUM")
+        return evicted
+
+    def close(self):
+        self.db.close()
+
+
+def onNetworkFilesystem(path):
+    # the type of the innermost mount holding path, from /proc/mounts (elsewhere than Linux every path counts as local)
+    path = os.path.realpath(path)
+    mountPoint = ""
+    fsType = None
+    try:
+        with open("/proc/mounts", "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1].replace("\\040", " ")
+                inside = path == mount or path.startswith(mount.rstrip("/") + "/")
+                if inside and len(mount) > len(mountPoint):
+                    mountPoint = mount
+                    fsType = fields[2]
+    except OSError:
+        return False
+    return fsType in NETWORK_FILESYSTEMS
+
+
+def proteinHash(protein):
+    return hashlib.sha256(str(protein).encode()).hexdigest()
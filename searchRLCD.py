@@ -1,16 +1,21 @@
 import os
+import json
+import shutil
+import socket
+import hashlib
 
+import click
+import numpy as np
 import pandas as pd
 
 # RLCD location on wi-files2: /lab/reddien_lab/databases/RLCD/
-# genesFile is a csv containing all genes to check in the RLCD
-# the csv must contain a 'ddID' column formatted like: "dd-Smed-v6-659-0-1" --> "659"
+# genesFile is a tsv containing all genes to check in the RLCD
+# the tsv must contain a 'dd ID' column formatted like: "dd-Smed-v6-659-0-1" --> "659"
 # a second column, 'Name' can be used in placed of the dd ID: "dd-Smed-v6-659-0-1" --> "smedwi-1" in Name column, dd ID can be left out
-genesFile = "genes.tsv"
-genes = pd.read_csv(genesFile, sep="\t")
-dbFile = "RLCD_20210730.xlsx"
-db = pd.read_excel(dbFile)
-# get dbinfo corresponding to geneinfo and combine
+# python searchRLCD.py -g genes.tsv -d RLCD_20210730.xlsx -o output.tsv
+
+DD_PATT = r"dd[_-]Smed[_-]v6[_-](\d+)"
+NAME_SPLIT = r"[,;/\s]+"
 geneInfo = ["Label", "dd ID", "Name"]
 dbInfo = [
     "Reddien Lab Construct Database Index Name",
@@ -22,30 +27,8 @@ dbInfo = [
     "Forward Primer",
     "Reverse Primer",
 ]
-out = pd.DataFrame()
-for i, g in genes.iterrows():
-    matches1 = db["Associated Contig"].str.contains(str(g["dd ID"]), na=False)
-    if g.get("Name") and pd.isna(g["dd ID"]):  # search by Name if no dd ID is given
-        matches2 = db["Gene Name"].str.contains(g["Name"], na=False)
-    else:
-        matches2 = []
-    matches = matches1
-    for j, m in db.loc[
-        matches,
-    ].iterrows():
-        x = g[geneInfo]
-        y = m[dbInfo]
-        merge = pd.concat([x, y], ignore_index=True).to_frame().T
-        out = pd.concat([out, merge], ignore_index=True)
-    matches = matches2
-    for j, m in db.loc[
-        matches,
-    ].iterrows():
-        x = g[geneInfo]
-        y = m[dbInfo]
-        merge = pd.concat([x, y], ignore_index=True).to_frame().T
-        out = pd.concat([out, merge], ignore_index=True)
-
+searchColumns = ["Associated Contig", "Gene Name"]
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "searchRLCD")
 # use short names for dbInfo in output
 shortNames = {
     "Reddien Lab Construct Database Index Name": "RLCD",
@@ -54,5 +37,203 @@ shortNames = {
     "Date Record Modified": "Modified",
     "Associated Contig": "Contig",
 }
-dbInfoShort = [shortNames.get(x, x) for x in dbInfo]
-out.to_csv("output.tsv", sep="\t", header=(geneInfo + dbInfoShort), index=False)
+
+
+@click.command()
+@click.option(
+    "-g",
+    "--genes",
+    required=True,
+    type=str,
+    help="Specify the tsv file with the 'Label', 'dd ID' and 'Name' of every gene to look up.",
+)
+@click.option(
+    "-d",
+    "--database",
+    required=True,
+    type=str,
+    help="Specify the RLCD spreadsheet (ex. RLCD_20210730.xlsx).",
+)
+@click.option(
+    "-o",
+    "--outfile",
+    type=str,
+    default="output.tsv",
+    help="Specify the name of the tsv output file containing all matching constructs.",
+)
+@click.option(
+    "-c",
+    "--cache_dir",
+    type=str,
+    default=None,
+    help="Directory for the columnar snapshot of the spreadsheet (defaults to <database>.columns next to it, or to ~/.cache/searchRLCD when that directory is not writable).",
+)
+def searchRLCD(genes, database, outfile, cache_dir):
+    genes = pd.read_csv(genes, sep="\t")
+    db = loadDatabase(database, dict.fromkeys(dbInfo + searchColumns), cache_dir)
+    out = findConstructs(genes, db)
+    dbInfoShort = [shortNames.get(x, x) for x in dbInfo]
+    out.to_csv(outfile, sep="\t", header=(geneInfo + dbInfoShort), index=False)
+
+
+def findConstructs(genes, db):
+    ddIndex, nameIndex = buildIndex(db)
+    genes = genes.reset_index(drop=True)
+    # dd IDs may be given as "659" or as a full contig name, genes without one are searched by Name
+    ddIDs = (
+        genes["dd ID"].astype("string").str.extract(f"(?:{DD_PATT}|^(\\d+)(?:\\.0)?$)")
+    )
+    queries = pd.DataFrame(
+        {
+            "gene": genes.index,
+            "ddID": ddIDs[0].fillna(ddIDs[1]),
+            "name": genes["Name"].astype("string").str.strip().str.lower(),
+            "byName": genes["dd ID"].isna(),
+        }
+    )
+    ddMatches = queries.dropna(subset=["ddID"]).merge(ddIndex, on="ddID")
+    nameMatches = queries[queries["byName"]].dropna(subset=["name"])
+    nameMatches = nameMatches.merge(nameIndex, on="name")
+    # one join for all genes: dd ID matches first, then Name matches, each in database order
+    matches = pd.concat(
+        [ddMatches.assign(kind=0), nameMatches.assign(kind=1)], ignore_index=True
+    )
+    matches = matches.drop_duplicates(["gene", "kind", "row"])
+    matches = matches.sort_values(["gene", "kind", "row"])
+    x = genes.loc[matches["gene"], geneInfo].reset_index(drop=True)
+    y = db.loc[matches["row"], dbInfo].reset_index(drop=True)
+    return pd.concat([x, y], axis=1, ignore_index=True)
+
+
+def buildIndex(db):
+    # inverted indexes from every dd ID and gene name mentioned in the database to its rows
+    contigs = db["Associated Contig"].astype("string").str.extractall(DD_PATT)
+    ddIndex = pd.DataFrame(
+        {"ddID": contigs[0].values, "row": contigs.index.get_level_values(0)}
+    )
+    names = db["Gene Name"].astype("string").str.lower().str.split(NAME_SPLIT)
+    names = names.explode().dropna()
+    nameIndex = pd.DataFrame({"name": names.values, "row": names.index})
+    nameIndex = nameIndex[nameIndex["name"] != ""]
+    return ddIndex.drop_duplicates(), nameIndex.drop_duplicates()
+
+
+def loadDatabase(database, columns, cacheDir=None):
+    # parsing the xlsx is slow, keep one memory-mappable .npy file per column and rebuild it only when the sheet changes
+    if cacheDir is None:
+        cacheDir = defaultCacheDir(database)
+    metaPath = os.path.join(cacheDir, "meta.json")
+    stat = os.stat(database)
+    meta = None
+    if os.path.exists(metaPath):
+        with open(metaPath, "r") as f:
+            meta = json.load(f)
+        if "snapshot" not in meta:
+            # written before snapshots got their own directory
+            meta = None
+        elif meta["mtime"] != stat.st_mtime or meta["size"] != stat.st_size:
+            if meta["size"] == stat.st_size and meta["sha256"] == fileHash(database):
+                meta["mtime"] = stat.st_mtime
+                writeMeta(metaPath, meta)
+            else:
+                meta = None
+    if meta is None:
+        meta = snapshotDatabase(database, cacheDir, stat)
+    snapshotDir = os.path.join(cacheDir, meta["snapshot"])
+    return pd.DataFrame(
+        {c: readColumn(snapshotDir, meta["columns"][c]) for c in columns},
+        index=pd.RangeIndex(meta["rows"]),
+    )
+
+
+def defaultCacheDir(database):
+    # next to the spreadsheet when possible, otherwise per user, named after the spreadsheet's full path
+    database = os.path.abspath(database)
+    if os.access(os.path.dirname(database), os.W_OK):
+        return f"{database}.columns"
+    pathHash = hashlib.sha256(database.encode()).hexdigest()[:16]
+    return os.path.join(
+        DEFAULT_CACHE, f"{pathHash}_{os.path.basename(database)}.columns"
+    )
+
+
+def snapshotDatabase(database, cacheDir, stat):
+    os.makedirs(cacheDir, exist_ok=True)
+    db = pd.read_excel(database)
+    sha256 = fileHash(database)
+    # every version of the sheet gets its own directory, written in a temporary one and moved into place,
+    # so a concurrent run never maps a half-written column
+    snapshot = f"snapshot-{sha256[:16]}"
+    tmpDir = os.path.join(cacheDir, f".snapshot.{socket.gethostname()}.{os.getpid()}")
+    shutil.rmtree(tmpDir, ignore_errors=True)
+    os.makedirs(tmpDir)
+    try:
+        columns = {}
+        for i, (name, values) in enumerate(db.items()):
+            fileName = f"column{i}"
+            if values.dtype.kind in "biufM":
+                np.save(os.path.join(tmpDir, f"{fileName}.npy"), values.to_numpy())
+                columns[name] = {"file": fileName, "text": False}
+            else:
+                # text and mixed columns become fixed-width unicode plus a missing-value mask, both mappable
+                text = values.astype("string").fillna("").to_numpy(dtype=str)
+                np.save(os.path.join(tmpDir, f"{fileName}.npy"), text)
+                np.save(
+                    os.path.join(tmpDir, f"{fileName}.na.npy"),
+                    values.isna().to_numpy(),
+                )
+                columns[name] = {"file": fileName, "text": True}
+        try:
+            os.replace(tmpDir, os.path.join(cacheDir, snapshot))
+        except OSError:
+            # a concurrent run already stored the same version
+            pass
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+    meta = {
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "sha256": sha256,
+        "rows": len(db),
+        "columns": columns,
+        "snapshot": snapshot,
+    }
+    writeMeta(os.path.join(cacheDir, "meta.json"), meta)
+    # drop the snapshots of older versions of the sheet and the column files of the old layout
+    for name in os.listdir(cacheDir):
+        path = os.path.join(cacheDir, name)
+        if name.startswith("snapshot-") and name != snapshot:
+            shutil.rmtree(path, ignore_errors=True)
+        elif name.startswith("column") and name.endswith(".npy"):
+            os.remove(path)
+    return meta
+
+
+def readColumn(snapshotDir, column):
+    values = np.load(os.path.join(snapshotDir, f"{column['file']}.npy"), mmap_mode="r")
+    if not column["text"]:
+        return values
+    missing = np.load(
+        os.path.join(snapshotDir, f"{column['file']}.na.npy"), mmap_mode="r"
+    )
+    return np.where(missing, None, values.astype(object))
+
+
+def fileHash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def writeMeta(metaPath, meta):
+    # one temporary file per process, concurrent runs may write the same meta
+    tmpPath = f"{metaPath}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmpPath, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmpPath, metaPath)
+
+
+if __name__ == "__main__":
+    searchRLCD()
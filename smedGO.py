@@ -1,9 +1,23 @@
 import csv
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 from intermine.webservice import Service
+from intermine.errors import WebserviceError
 
-service = Service("https://planmine.mpibpc.mpg.de:443/planmine/service")
+from goCache import GOCache, DEFAULT_CACHE
+
+PLANMINE = "https://planmine.mpibpc.mpg.de:443/planmine/service"
+GO_VIEW = [
+    "primaryIdentifier",
+    "domainHits.proteinDomain.goAnnotation.ontologyTerm.identifier",
+    "domainHits.proteinDomain.goAnnotation.ontologyTerm.name",
+    "domainHits.proteinDomain.goAnnotation.ontologyTerm.description",
+]
+# each worker thread keeps and reuses its own Service connection
+services = threading.local()
 
 
 @click.command()
@@ -26,7 +40,78 @@ service = Service("https://planmine.mpibpc.mpg.de:443/planmine/service")
     type=str,
     help="Specify the output path for the results (results are in tab-separated format or .tsv).",
 )
-def queryContigs(contigs, infile, outfile):
+@click.option(
+    "-s",
+    "--service",
+    type=str,
+    default=PLANMINE,
+    help="Specify the intermine service to query (defaults to PlanMine).",
+)
+@click.option(
+    "-b",
+    "--batch_size",
+    type=int,
+    default=200,
+    help="Number of contigs to look up in a single query.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=4,
+    help="Number of queries to run concurrently.",
+)
+@click.option(
+    "-r",
+    "--rate",
+    type=float,
+    default=5,
+    help="Maximum number of queries started per second.",
+)
+@click.option(
+    "--retries",
+    type=int,
+    default=3,
+    help="Number of times a failed query is retried, with exponential backoff.",
+)
+@click.option(
+    "--cache",
+    type=str,
+    default=DEFAULT_CACHE,
+    help="Specify the local GO cache (fill it in bulk with goCache.py).",
+)
+@click.option(
+    "--ttl",
+    type=float,
+    default=90,
+    help="Number of days cached GO terms are trusted before they are fetched again.",
+)
+@click.option(
+    "--offline",
+    type=bool,
+    default=False,
+    help="Only answer from the local GO cache, never contact the service.",
+)
+@click.option(
+    "--release",
+    type=str,
+    default=None,
+    help="PlanMine release to use from the cache (defaults to the service's release, or the newest cached one offline).",
+)
+def queryContigs(
+    contigs,
+    infile,
+    outfile,
+    service,
+    batch_size,
+    workers,
+    rate,
+    retries,
+    cache,
+    ttl,
+    offline,
+    release,
+):
     if contigs and not infile:
         contigs = contigs.split(",")
     elif not contigs and infile:
@@ -37,7 +122,47 @@ def queryContigs(contigs, infile, outfile):
         raise (
             "Contigs must be provided as either a comma-separated list in the command line or as a comma-separated input file."
         )
-    output = [queryContig(c) for c in contigs]
+    # answer from the local cache first, offline runs stop there
+    goCache = GOCache(cache)
+    if release is None:
+        release = goCache.latestRelease() if offline else getService(service).release
+    found = goCache.get(contigs, release, None if offline else ttl * 24 * 3600)
+    missing = [c for c in dict.fromkeys(contigs) if c not in found]
+    if offline:
+        print(
+            f"{len(missing)} contigs are not in the local GO cache for release {release}"
+        )
+    elif missing:
+        # look the rest up in batches, a few batches at a time
+        limiter = RateLimiter(rate)
+        batches = [
+            missing[i : i + batch_size] for i in range(0, len(missing), batch_size)
+        ]
+        unknown = []
+        with ThreadPoolExecutor(workers) as executor:
+            for terms, notFound in executor.map(
+                lambda batch: queryBatch(service, batch, limiter, retries), batches
+            ):
+                goCache.put(terms, release)
+                found.update(terms)
+                unknown += notFound
+            # ids the service does not know may still match another key field, one LOOKUP each
+            for terms in executor.map(
+                lambda contig: lookupContig(service, contig, limiter, retries), unknown
+            ):
+                goCache.put(terms, release)
+                found.update(terms)
+    goCache.close()
+    output = []
+    for c in contigs:
+        if c not in found:
+            output.append(
+                [{"contig": c, "name": "", "description": "not in local cache"}]
+            )
+        elif found[c] == []:
+            output.append([{"contig": c, "name": "", "description": "no match found"}])
+        else:
+            output.append(found[c])
     header = ["contig", "names", "descriptions"]
     with open(outfile, "w") as f:
         writer = csv.writer(f, delimiter="\t")
@@ -52,31 +177,106 @@ def queryContigs(contigs, infile, outfile):
             writer.writerow([contig, names, descriptions])
 
 
-def queryContig(contig):
-    query = service.new_query("Contig")
-    query.add_view(
-        "primaryIdentifier",
-        "domainHits.proteinDomain.goAnnotation.ontologyTerm.identifier",
-        "domainHits.proteinDomain.goAnnotation.ontologyTerm.name",
-        "domainHits.proteinDomain.goAnnotation.ontologyTerm.description",
+class RateLimiter:
+    # spaces out the start of queries shared by all worker threads
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def getService(url):
+    if getattr(services, "url", None) != url:
+        services.url = url
+        services.service = Service(url)
+    return services.service
+
+
+def queryBatch(url, contigs, limiter, retries):
+    # the GO terms of the contigs the service knows by primary identifier (ignoring case) and the
+    # contigs it does not know, which lookupContig tries again
+    rows = runQuery(
+        url,
+        limiter,
+        retries,
+        ["primaryIdentifier"],
+        lambda query: query.add_constraint(
+            "primaryIdentifier", "ONE OF", contigs, code="A"
+        ),
+    )
+    requested = {}
+    for contig in contigs:
+        requested.setdefault(contig.lower(), []).append(contig)
+    known = {row["primaryIdentifier"] for row in rows}
+    # a contig without any GO term has no row here, so only ask for the terms of known contigs
+    terms = {
+        contig: []
+        for identifier in known
+        for contig in requested.get(identifier.lower(), [])
+    }
+    if known:
+        rows = runQuery(
+            url,
+            limiter,
+            retries,
+            GO_VIEW,
+            lambda query: query.add_constraint(
+                "primaryIdentifier", "ONE OF", sorted(known), code="A"
+            ),
+        )
+        for row in rows:
+            for contig in requested.get(row["primaryIdentifier"].lower(), []):
+                terms[contig].append(goTerm(contig, row))
+    return terms, [c for c in contigs if c not in terms]
+
+
+def lookupContig(url, contig, limiter, retries):
+    # LOOKUP also matches other key fields than the primary identifier, like the single-contig query did
+    rows = runQuery(
+        url,
+        limiter,
+        retries,
+        GO_VIEW,
+        lambda query: query.add_constraint("Contig", "LOOKUP", contig, code="A"),
     )
-    query.add_constraint("Contig", "LOOKUP", contig, code="A")
-
-    terms = []
-    for row in query.rows():
-        term = {
-            "contig": contig,
-            "name": row["domainHits.proteinDomain.goAnnotation.ontologyTerm.name"],
-            "description": row[
-                "domainHits.proteinDomain.goAnnotation.ontologyTerm.description"
-            ],
-        }
-        terms.append(term)
-
-    if terms == []:
-        terms = [{"contig": contig, "name": "", "description": "no match found"}]
-
-    return terms
+    return {contig: [goTerm(contig, row) for row in rows]}
+
+
+def runQuery(url, limiter, retries, view, constrain):
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            query = getService(url).new_query("Contig")
+            query.add_view(*view)
+            constrain(query)
+            return list(query.rows())
+        except (WebserviceError, OSError):
+            if attempt == retries:
+                raise
+            # drop the connection in case it went bad and back off before retrying
+            services.url = None
+            time.sleep(2**attempt)
+
+
+def goTerm(contig, row):
+    return {
+        "contig": contig,
+        "identifier": row[
+            "domainHits.proteinDomain.goAnnotation.ontologyTerm.identifier"
+        ],
+        "name": row["domainHits.proteinDomain.goAnnotation.ontologyTerm.name"],
+        "description": row[
+            "domainHits.proteinDomain.goAnnotation.ontologyTerm.description"
+        ],
+    }
 
 
 if __name__ == "__main__":
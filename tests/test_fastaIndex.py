@@ -0,0 +1,55 @@
+import os
+import sys
+
+from Bio import SeqIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastaIndex import FastaIndex
+
+IRREGULAR = (
+    b">a first\nACGTACGT\nACG\n\n"
+    b">b\r\nACGTAC\r\n\r\n\r\n"
+    b">c\nACGTACGT\nACGTACGT\nA\n>d\nAC\n\n"
+)
+
+
+def records(index):
+    return [
+        (r.id, str(r.seq)) for i in range(len(index)) for r in index.slice(i, i + 1)
+    ]
+
+
+def test_blank_lines_between_records(tmp_path):
+    path = tmp_path / "irregular.fasta"
+    path.write_bytes(IRREGULAR)
+    expected = [(r.id, str(r.seq)) for r in SeqIO.parse(path, "fasta")]
+    # a second run must not trust a .fai that cannot describe the file
+    assert records(FastaIndex(str(path))) == expected
+    assert records(FastaIndex(str(path))) == expected
+    assert str(FastaIndex(str(path))["d"].seq) == "AC"
+
+
+def test_stale_fai_with_wrong_starts(tmp_path):
+    path = tmp_path / "irregular.fasta"
+    path.write_bytes(IRREGULAR)
+    expected = [(r.id, str(r.seq)) for r in SeqIO.parse(path, "fasta")]
+    # a .fai written before blank lines were detected puts the later records on the blank lines
+    with open(f"{path}.fai", "w") as f:
+        f.write("a\t11\t9\t8\t9\nb\t6\t26\t6\t8\nc\t17\t39\t8\t9\nd\t2\t62\t2\t3\n")
+    assert records(FastaIndex(str(path))) == expected
+
+
+def test_regular_fasta_keeps_its_fai(tmp_path):
+    path = tmp_path / "regular.fasta"
+    path.write_bytes(b">a\nACGT\nAC\n>b\nACGT\n")
+    index = FastaIndex(str(path))
+    assert os.path.exists(f"{path}.fai")
+    assert (
+        records(FastaIndex(str(path)))
+        == records(index)
+        == [
+            ("a", "ACGTAC"),
+            ("b", "ACGT"),
+        ]
+    )